@@ -12,35 +12,52 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 try:
-    from urllib2 import Request, urlopen, HTTPError
+    from urllib2 import Request, build_opener, HTTPError
     from urllib import urlencode
+    from urlparse import urlparse
 except ImportError:
     # is Python3
-    from urllib.request import Request, urlopen
+    from urllib.request import Request, build_opener
     from urllib.error import HTTPError
-    from urllib.parse import urlencode
+    from urllib.parse import urlencode, urlparse
 
+try:
+    from Queue import Queue, Full
+except ImportError:
+    # is Python3
+    from queue import Queue, Full
+
+import collections
+import functools
 import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import core
 
 API_ROOT = 'https://api.parse.com/1'
 ACCESS_KEYS = {}
 
+# default number of worker threads used to run requests concurrently
+CONCURRENCY = 8
+
 
 def register(app_id, rest_key, **kw):
+    """
+    Set up the default client, used when no other ParseClient is active.
+    Takes the same arguments as ParseClient.
+    """
     global ACCESS_KEYS
-    ACCESS_KEYS = {
-        'app_id': app_id,
-        'rest_key': rest_key
-        }
-    ACCESS_KEYS.update(**kw)
+    client = ParseClient(app_id, rest_key, **kw)
+    ParseClient._default = client
+    ACCESS_KEYS = client.access_keys
 
 
 def master_key_required(func):
     '''decorator describing methods that require the master key'''
     def ret(obj, *args, **kw):
-        conn = ACCESS_KEYS
+        conn = ParseClient.current().access_keys
         if not (conn and conn.get('master_key')):
             message = '%s requires the master key' % func.__name__
             raise core.ParseError(message)
@@ -48,6 +65,367 @@ def master_key_required(func):
     return ret
 
 
+class RateLimiter(object):
+    """
+    Token bucket allowing on average rate calls to wait() per second, in
+    bursts of up to burst calls. wait() blocks until the call is allowed.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # take the token now, even if it is only available later
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class TTLCache(object):
+    """
+    Thread safe mapping whose entries expire ttl seconds after being set,
+    holding at most maxsize entries (the least recently set are dropped
+    first)
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.time():
+                del self._items[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time() + (ttl or self.ttl))
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, (default, None))[0]
+
+    def remove_if(self, predicate):
+        """remove the entries whose value predicate returns True for"""
+        with self._lock:
+            for key, (value, _) in list(self._items.items()):
+                if predicate(value):
+                    del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ParseClient(object):
+    """
+    The credentials and settings used to talk to one Parse app. Requests
+    are sent with the current client: the innermost one used as a context
+    manager in this thread, or else the default client set up by
+    register(). Each thread can use a different client at the same time:
+
+        with ParseClient(app_id, rest_key, master_key=master_key):
+            scores = GameScore.Query.all()
+
+    api_root replaces API_ROOT in the urls requested, concurrency is the
+    number of threads in the pool the client sends concurrent requests
+    with (see parallel_map) and rate_limit the most
+    requests per second to send. Other keyword arguments (master_key) are
+    kept with the credentials.
+    """
+    _local = threading.local()
+    _default = None
+
+    # how many validated session tokens are cached, and for how long valid
+    # and invalid ones are trusted (see User.validate_session)
+    SESSION_CACHE_SIZE = 10000
+    SESSION_TTL = 300
+    INVALID_SESSION_TTL = 60
+
+    # how many results of idempotent cloud functions are cached (see
+    # datatypes.Function)
+    FUNCTION_CACHE_SIZE = 1000
+
+    def __init__(self, app_id, rest_key, api_root=None, concurrency=None,
+                 rate_limit=None, **kw):
+        self.access_keys = dict(kw, app_id=app_id, rest_key=rest_key)
+        self.api_root = api_root and api_root.rstrip('/')
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.limiter = rate_limit and RateLimiter(rate_limit) or None
+        # urllib2 doesn't keep connections alive, so this is a client's
+        # own set of handlers rather than a pool of connections
+        self.opener = build_opener()
+        # session token -> user data, and invalid session tokens
+        self.sessions = TTLCache(self.SESSION_CACHE_SIZE, self.SESSION_TTL)
+        self.invalid_sessions = TTLCache(self.SESSION_CACHE_SIZE,
+                                         self.INVALID_SESSION_TTL)
+        # (function, session token, arguments) -> response
+        self.function_results = TTLCache(self.FUNCTION_CACHE_SIZE, 60)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @classmethod
+    def current(cls):
+        """the client requests made in this thread are sent with"""
+        stack = getattr(cls._local, 'stack', None)
+        if stack:
+            return stack[-1]
+        client = cls._default
+        if client is None or client.access_keys is not ACCESS_KEYS:
+            # ACCESS_KEYS was replaced without register(): follow it
+            client = cls._default = cls(ACCESS_KEYS.get('app_id'),
+                                        ACCESS_KEYS.get('rest_key'))
+            client.access_keys = ACCESS_KEYS
+        return client
+
+    @classmethod
+    def _active(cls):
+        """
+        the client used as a context manager in this thread, if any other
+        than the default client
+        """
+        stack = getattr(cls._local, 'stack', None)
+        client = stack[-1] if stack else None
+        return client if client is not cls._default else None
+
+    def __enter__(self):
+        self._local.__dict__.setdefault('stack', []).append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._local.stack.pop()
+
+    def __copy__(self):
+        # querysets and objects are copied, the client they use is shared
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        # objects bound to a client can be pickled: only its settings are
+        # kept, the connections, rate limiter and caches start afresh
+        return {'access_keys': self.access_keys, 'api_root': self.api_root,
+                'concurrency': self.concurrency,
+                'rate_limit': self.rate_limit}
+
+    def __setstate__(self, state):
+        kw = dict(state['access_keys'])
+        self.__init__(kw.pop('app_id'), kw.pop('rest_key'),
+                      api_root=state['api_root'],
+                      concurrency=state['concurrency'],
+                      rate_limit=state['rate_limit'], **kw)
+
+    def pool(self):
+        """
+        the pool of worker threads parallel_map runs calls on, created the
+        first time it is needed and then shared by every call
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.concurrency or CONCURRENCY,
+                                        _start_worker)
+            return self._pool
+
+    def url(self, url):
+        """url on this client's server of a url under API_ROOT"""
+        if self.api_root and url.startswith(API_ROOT):
+            return self.api_root + url[len(API_ROOT):]
+        return url
+
+    def open(self, request):
+        if self.limiter is not None:
+            self.limiter.wait()
+        return self.opener.open(request)
+
+
+class Session(object):
+    """
+    Send the requests made in this thread inside a with block on behalf of
+    a user, with their session token rather than the master key, so that
+    the user's permissions apply:
+
+        with Session(user.sessionToken):
+            posts = Post.Query.all()
+
+    Session(None) goes back to sending requests without a session token.
+    """
+    _local = threading.local()
+
+    def __init__(self, session_token):
+        self.session_token = session_token
+
+    @classmethod
+    def current(cls):
+        """the innermost session active in this thread, if any"""
+        stack = getattr(cls._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @classmethod
+    def current_token(cls):
+        session = cls.current()
+        return session and session.session_token
+
+    def __enter__(self):
+        self._local.__dict__.setdefault('stack', []).append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._local.stack.pop()
+
+
+def bind_context(func):
+    """
+    Wrap func to run with the client and session current in the calling
+    thread, for running it in another thread
+    """
+    client = ParseClient.current()
+    session = Session.current()
+
+    def run(*args, **kw):
+        with client:
+            if session is None:
+                return func(*args, **kw)
+            with session:
+                return func(*args, **kw)
+    return run
+
+
+def with_client(method):
+    """
+    Decorator for methods of objects bound to a client (see ParseResource):
+    run the method with that client
+    """
+    @functools.wraps(method)
+    def run(self, *args, **kw):
+        client = self.__dict__.get('_client')
+        if client is None:
+            return method(self, *args, **kw)
+        with client:
+            return method(self, *args, **kw)
+    return run
+
+
+# marks the threads of the clients' pools
+_worker = threading.local()
+
+
+def _start_worker():
+    _worker.active = True
+
+
+def parallel_map(func, items, concurrency=None):
+    """
+    Call func on every item on the current client's pool of worker threads
+    (see ParseClient.pool), with up to concurrency calls running at once,
+    and return the results in the same order as items. If any call raises,
+    the exception is re-raised here. The calls use the current client and
+    session of the calling thread.
+    """
+    items = list(items)
+    client = ParseClient.current()
+    concurrency = concurrency or client.concurrency or CONCURRENCY
+    if (concurrency <= 1 or len(items) <= 1 or
+            getattr(_worker, 'active', False)):
+        # calls from a worker run in it: waiting for the pool from one of
+        # its own threads could deadlock it
+        return [func(item) for item in items]
+
+    func = bind_context(func)
+    pool = client.pool()
+    results, running = [], collections.deque()
+    for item in items:
+        if len(running) >= concurrency:
+            results.append(running.popleft().get())
+        running.append(pool.apply_async(func, (item,)))
+    results.extend(call.get() for call in running)
+    return results
+
+
+def prefetch(iterable, depth):
+    """
+    Iterate over iterable on a background thread, keeping up to depth
+    items ready ahead of the consumer. Exceptions raised while producing
+    items are re-raised to the consumer.
+    """
+    return interleave([iterable], depth)
+
+
+def interleave(iterables, depth):
+    """
+    Iterate over several iterables at once, each on its own background
+    thread, yielding their items as they become ready. Up to depth items
+    are kept ready ahead of the consumer. Exceptions raised while
+    producing items are re-raised to the consumer.
+    """
+    buffer = Queue(maxsize=depth)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce(iterable):
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    produce = bind_context(produce)
+    for iterable in iterables:
+        thread = threading.Thread(target=produce, args=(iterable,))
+        thread.daemon = True
+        thread.start()
+    running = len(iterables)
+    try:
+        while running:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                running -= 1
+                continue
+            yield item
+    finally:
+        # the consumer may stop early: let the producer threads finish
+        stopped.set()
+
+
 class ParseBase(object):
     ENDPOINT_ROOT = API_ROOT
 
@@ -59,29 +437,65 @@ class ParseBase(object):
         If batch == True, return the dictionary that would be used in a batch
         command.
         """
+        url = cls._url(uri)
         if batch:
             ret = {"method": http_verb,
-                   "path": uri.split("parse.com")[1]}
+                   "path": urlparse(url).path}
             if kw:
                 ret["body"] = kw
             return ret
 
-        if not ('app_id' in ACCESS_KEYS and 'rest_key' in ACCESS_KEYS):
-            raise core.ParseError('Missing connection credentials')
-
-        app_id = ACCESS_KEYS.get('app_id')
-        rest_key = ACCESS_KEYS.get('rest_key')
-        master_key = ACCESS_KEYS.get('master_key')
-
         headers = extra_headers or {}
-        url = uri if uri.startswith(API_ROOT) else cls.ENDPOINT_ROOT + uri
         data = kw and json.dumps(kw) or "{}"
         if http_verb == 'GET' and data:
             url += '?%s' % urlencode(kw)
             data = None
 
+        response = cls._open(url, http_verb, data, headers)
+        return json.loads(response.read())
+
+    @classmethod
+    def execute_stream(cls, uri, http_verb, body, content_type,
+                       content_length, extra_headers=None):
+        """
+        Like execute, but send body as it is instead of JSON-encoding the
+        keyword arguments. body may be a file-like object (or an mmap), in
+        which case it is streamed to Parse in blocks.
+        """
+        headers = dict(extra_headers or {})
+        headers['Content-Length'] = str(content_length)
+        url = cls._url(uri)
+        response = cls._open(url, http_verb, body, headers, content_type)
+        return json.loads(response.read())
+
+    @classmethod
+    def _url(cls, uri):
+        """absolute url of uri for the current client"""
+        client = ParseClient.current()
+        if not uri.startswith(API_ROOT) and not (
+                client.api_root and uri.startswith(client.api_root)):
+            uri = cls.ENDPOINT_ROOT + uri
+        return client.url(uri)
+
+    @classmethod
+    def _open(cls, url, http_verb, data, headers,
+              content_type='application/json'):
+        """send an authenticated request and return the open response"""
+        client = ParseClient.current()
+        access_keys = client.access_keys
+        if not (access_keys.get('app_id') and access_keys.get('rest_key')):
+            raise core.ParseError('Missing connection credentials')
+
+        app_id = access_keys.get('app_id')
+        rest_key = access_keys.get('rest_key')
+        master_key = access_keys.get('master_key')
+
+        session_token = Session.current_token()
+        if session_token and 'X-Parse-Session-Token' not in headers:
+            headers = dict(headers, **{'X-Parse-Session-Token': session_token})
+
         request = Request(url, data, headers)
-        request.add_header('Content-type', 'application/json')
+        request.add_header('Content-type', content_type)
         request.add_header('X-Parse-Application-Id', app_id)
         request.add_header('X-Parse-REST-API-Key', rest_key)
 
@@ -91,7 +505,7 @@ class ParseBase(object):
         request.get_method = lambda: http_verb
 
         try:
-            response = urlopen(request)
+            return client.open(request)
         except HTTPError as e:
             exc = {
                 400: core.ResourceRequestBadRequest,
@@ -101,8 +515,6 @@ class ParseBase(object):
                 }.get(e.code, core.ParseError)
             raise exc(e.read())
 
-        return json.loads(response.read())
-
     @classmethod
     def GET(cls, uri, **kw):
         return cls.execute(uri, 'GET', **kw)
@@ -120,30 +532,342 @@ class ParseBase(object):
         return cls.execute(uri, 'DELETE', **kw)
 
 
+def _raise_batch_errors(objects, results):
+    """raise a ParseBatchError listing the objects whose operation failed"""
+    errors = [(obj, result.error)
+              for obj, result in zip(objects, results)
+              if not result.ok]
+    if errors:
+        raise core.ParseBatchError(errors)
+
+
+class BatchResult(object):
+    """The outcome of one operation sent in a batch request"""
+    # Parse error codes of failures that may go away when retrying. A
+    # request over the request limit wasn't applied, so it can always be
+    # sent again
+    RETRYABLE_CODES = (155,)
+    # internal server error, connection failed and timeout: the request
+    # may have been applied, so only idempotent ones are sent again
+    TRANSIENT_CODES = (1, 100, 124)
+
+    def __init__(self, request, response):
+        self.request = request
+        self.success = response.get('success')
+        self.error = response.get('error')
+
+    ok = property(lambda self: self.error is None)
+    transient = property(
+        lambda self: not self.ok and
+        self.error.get('code') in self.TRANSIENT_CODES)
+    retryable = property(
+        lambda self: not self.ok and
+        (self.error.get('code') in self.RETRYABLE_CODES or
+         self.transient and self.idempotent))
+
+    @property
+    def idempotent(self):
+        """whether sending the request again would do no more harm"""
+        body = self.request.get('body') or {}
+        atomic = any(isinstance(value, dict) and '__op' in value
+                     for value in body.values())
+        return (self.request.get('method') == 'DELETE' or
+                self.request.get('method') == 'PUT' and not atomic)
+
+    def __repr__(self):
+        return '<BatchResult:%s>' % (self.ok and 'ok' or self.error)
+
+
 class ParseBatcher(ParseBase):
     """Batch together create, update or delete operations"""
     ENDPOINT_ROOT = '/'.join((API_ROOT, 'batch'))
+    # the most operations Parse accepts in a single batch request
+    BATCH_SIZE = 50
 
-    def batch(self, methods):
+    # how many times operations that failed with a retryable error are
+    # sent again, and the delay before the first retry (doubled each time)
+    RETRIES = 3
+    RETRY_DELAY = 0.5
+
+    def __init__(self, client=None):
+        """client sends the batches, by default the current client"""
+        self.client = client
+
+    def batch(self, methods, retries=None, retry_unsafe=False):
         """
         Given a list of create, update or delete methods to call, call all
-        of them in a single batch operation.
+        of them in as few batch operations as possible. Returns a
+        BatchResult per method. Callbacks (updating the objects, etc) only
+        run for the operations that succeeded, and operations that failed
+        with a retryable error are sent again, up to `retries` times.
+        Creates and atomic operations that failed with a transient error
+        may have been applied, and are only sent again with retry_unsafe.
         """
+        with self.client or ParseClient.current():
+            return self._batch(methods, retries, retry_unsafe)
+
+    def _batch(self, methods, retries, retry_unsafe):
         try:
             queries, callbacks = zip(*[m(batch=True) for m in methods])
         except ValueError:
-            return
-        # perform all the operations in one batch
-        responses = self.execute("", "POST", requests=queries)
-        # perform the callbacks with the response data (updating the existing
-        # objets, etc)
-        for callback, response in zip(callbacks, responses):
-            callback(response["success"])
+            return []
+        if retries is None:
+            retries = self.RETRIES
+
+        results = [None] * len(queries)
+        pending = list(range(len(queries)))
+        delay = self.RETRY_DELAY
+        for attempt in range(retries + 1):
+            failed = []
+            for start in range(0, len(pending), self.BATCH_SIZE):
+                indexes = pending[start:start + self.BATCH_SIZE]
+                responses = self.execute(
+                    "", "POST", requests=[queries[i] for i in indexes])
+                for i, response in zip(indexes, responses):
+                    results[i] = BatchResult(queries[i], response)
+                    if results[i].ok:
+                        callbacks[i](results[i].success)
+                    elif results[i].retryable or (retry_unsafe and
+                                                  results[i].transient):
+                        failed.append(i)
+            if not failed or attempt == retries:
+                break
+            time.sleep(delay)
+            delay *= 2
+            pending = failed
+        return results
 
     def batch_save(self, objects):
         """save a list of objects in one operation"""
-        self.batch([o.save for o in objects])
+        return self.batch([o.save for o in objects])
 
     def batch_delete(self, objects):
         """delete a list of objects in one operation"""
-        self.batch([o.delete for o in objects])
+        return self.batch([o.delete for o in objects])
+
+
+class AtomicOpsBuffer(object):
+    """
+    Collect atomic operations (Increment, Add, AddUnique and Remove)
+    instead of sending a request for each one. Operations on the same
+    field of the same object are merged, and everything pending is sent
+    as batched updates once max_objects objects have pending operations,
+    max_delay seconds after an operation is buffered, when flush() is
+    called or when the with block using the buffer exits. An error from a
+    flush after max_delay is raised by the next add(), flush() or exit:
+
+        with AtomicOpsBuffer():
+            for score in scores:
+                score.increment('plays')
+    """
+    _local = threading.local()
+
+    def __init__(self, max_objects=ParseBatcher.BATCH_SIZE, max_delay=None):
+        self.max_objects = max_objects
+        self.max_delay = max_delay
+        self._lock = threading.RLock()
+        self._pending = collections.OrderedDict()
+        self._timer = None
+        # the error of the last flush run by the timer, if it failed
+        self._error = None
+
+    @classmethod
+    def current(cls):
+        """the innermost buffer active in this thread, if any"""
+        stack = getattr(cls._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def _activate(self):
+        self._local.__dict__.setdefault('stack', []).append(self)
+
+    def _deactivate(self):
+        self._local.stack.remove(self)
+
+    def __enter__(self):
+        self._activate()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._deactivate()
+        self.flush()
+
+    def add(self, obj, key, op):
+        """buffer the operation op (a dict with an '__op') on obj.key"""
+        with self._lock:
+            self._raise_error()
+            updates = self._pending.setdefault(id(obj), (obj, []))[1]
+            if not updates or (key in updates[-1] and
+                               updates[-1][key]['__op'] != op['__op']):
+                # Parse can't apply two different operations to the same
+                # field in one request, so they go in a second update
+                updates.append({})
+            updates[-1][key] = self._merge(updates[-1].get(key), op)
+
+            if len(self._pending) >= self.max_objects:
+                self.flush()
+            elif self.max_delay is not None and self._timer is None:
+                self._timer = threading.Timer(self.max_delay,
+                                              bind_context(self._timed_flush))
+                self._timer.daemon = True
+                self._timer.start()
+
+    @staticmethod
+    def _merge(pending, op):
+        merged = dict(op)
+        if pending is None:
+            return merged
+        if op['__op'] == 'Increment':
+            merged['amount'] = pending['amount'] + op['amount']
+        elif op['__op'] == 'Add':
+            merged['objects'] = pending['objects'] + op['objects']
+        else:
+            # AddUnique and Remove both treat their objects as a set
+            merged['objects'] = list(pending['objects'])
+            for item in op['objects']:
+                if item not in merged['objects']:
+                    merged['objects'].append(item)
+        return merged
+
+    def flush(self):
+        """
+        send every pending operation, one update per object, raising a
+        ParseBatchError if some failed
+        """
+        with self._lock:
+            self._send(self._drain())
+            self._raise_error()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            # nobody would see it in the timer's thread
+            with self._lock:
+                self._error = e
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _send(pending):
+        """
+        send (object, updates) pairs: the updates of an object are sent
+        one batch after another, in order, and those following a failed
+        one are dropped
+        """
+        errors = []
+        while pending:
+            results = ParseBatcher().batch(
+                [functools.partial(obj._update, fields=updates[0])
+                 for obj, updates in pending])
+            errors += [(obj, result.error)
+                       for (obj, _), result in zip(pending, results)
+                       if not result.ok]
+            pending = [(obj, updates[1:])
+                       for (obj, updates), result in zip(pending, results)
+                       if result.ok and len(updates) > 1]
+        if errors:
+            raise core.ParseBatchError(errors)
+
+    def take(self, obj):
+        """
+        remove and return the updates pending for obj (dicts of
+        operations by field), when a save sends its values instead
+        """
+        with self._lock:
+            return self._pending.pop(id(obj), (obj, None))[1]
+
+    def _drain(self):
+        """remove the pending operations, returning (object, updates) pairs"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending = list(self._pending.values())
+            self._pending.clear()
+        return pending
+
+
+class UnitOfWork(object):
+    """
+    Defer the save(), delete() and increment() calls made inside a with
+    block, and send them in as few batch requests as possible when it
+    exits:
+
+        with UnitOfWork():
+            order.save()
+            order.increment('revision')
+            cart.delete()
+
+    Saving the same object several times only sends it once, with its
+    latest state, and deleting an object drops its pending save. New
+    objects that pending saves point to are created first, as with
+    save(cascade=True). Nothing is sent if the block raises. A
+    ParseBatchError listing each failed object is raised if some of the
+    operations fail.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self._saves = collections.OrderedDict()
+        self._deletes = collections.OrderedDict()
+        self._ops = AtomicOpsBuffer(max_objects=float('inf'))
+
+    @classmethod
+    def current(cls):
+        """the innermost unit of work active in this thread, if any"""
+        stack = getattr(cls._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        self._local.__dict__.setdefault('stack', []).append(self)
+        self._ops._activate()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._ops._deactivate()
+        self._local.stack.remove(self)
+        if exc_type is None:
+            self.flush()
+
+    def save(self, obj):
+        self._deletes.pop(id(obj), None)
+        self._saves[id(obj)] = obj
+
+    def delete(self, obj):
+        self._saves.pop(id(obj), None)
+        if obj.objectId:
+            self._deletes[id(obj)] = obj
+
+    def flush(self):
+        """send every pending operation"""
+        from datatypes import ParseResource
+
+        # new objects referenced by other pending saves have to be created
+        # first so that pointers to them can be sent
+        levels = ParseResource._save_levels(self._saves.values())
+        deletes = list(self._deletes.values())
+        self._deletes.clear()
+        # the saves send the objects' current values, which already include
+        # the effect of their pending atomic operations
+        saved = set(id(o) for o in self._saves.values())
+        ops = [(obj, updates) for obj, updates in self._ops._drain()
+               if id(obj) not in saved]
+        self._saves.clear()
+
+        for level in levels[:-1]:
+            _raise_batch_errors(level, ParseBatcher().batch_save(level))
+
+        saves = levels and levels[-1] or []
+        methods = [o.save for o in saves]
+        methods += [functools.partial(obj._update, fields=updates[0])
+                    for obj, updates in ops]
+        methods += [o.delete for o in deletes]
+        objects = saves + [o for o, _ in ops] + deletes
+        results = ParseBatcher().batch(methods)
+        _raise_batch_errors(objects, results)
+        # further updates of objects whose operations conflicted
+        AtomicOpsBuffer._send([(obj, updates[1:]) for obj, updates in ops
+                               if len(updates) > 1])
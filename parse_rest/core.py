@@ -35,3 +35,13 @@ class ResourceRequestForbidden(ParseError):
 class ResourceRequestNotFound(ParseError):
     '''Request returns a 404'''
     pass
+
+
+class ParseBatchError(ParseError):
+    '''Some of the operations sent in batch requests failed'''
+    def __init__(self, errors):
+        super(ParseBatchError, self).__init__(
+            '%d batch operations failed' % len(errors))
+        # list of (object, error) pairs, error being the dict Parse
+        # returned for that object's operation
+        self.errors = errors
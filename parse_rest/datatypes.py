@@ -11,10 +11,26 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+try:
+    from urllib2 import urlopen
+    from urllib import quote, quote_plus
+except ImportError:
+    # is Python3
+    from urllib.request import urlopen
+    from urllib.parse import quote, quote_plus
+
 import base64
+import copy
 import datetime
-
-from connection import API_ROOT, ParseBase
+import json
+import mimetypes
+import mmap
+import os
+
+from connection import API_ROOT, ParseBase, ParseBatcher, ParseClient, \
+    Session, parallel_map, with_client, AtomicOpsBuffer, UnitOfWork, \
+    _raise_batch_errors
+import core
 import query 
 
 
@@ -43,9 +59,7 @@ class ParseType(object):
         is_object = isinstance(python_object, Object)
 
         if is_object and not as_pointer:
-            return dict([(k, ParseType.convert_to_parse(v, as_pointer=True))
-                         for k, v in python_object._editable_attrs.items()
-                         ])
+            return python_object._to_native()
 
 
         python_type = type(python_object)
@@ -99,14 +113,93 @@ class Pointer(ParseType):
 
 
 class Relation(ParseType):
+    """
+    A Relation field: a many-to-many relation stored by Parse. The related
+    objects are queried with $relatedTo, and add() and remove() are sent
+    as AddRelation/RemoveRelation operations in the next save() of the
+    object holding the relation. Use Object.relation(key) to get one.
+    """
+
     @classmethod
     def from_native(cls, **kw):
-        pass
+        return cls(kw.get('className'))
+
+    @staticmethod
+    def _is_unchanged(value):
+        """
+        whether value is a relation without pending operations. Parse
+        doesn't accept relations being set directly, so they are left out
+        of the data sent when saving an object.
+        """
+        if isinstance(value, Relation):
+            return not (value._added or value._removed)
+        return isinstance(value, dict) and value.get('__type') == 'Relation'
+
+    def __init__(self, class_name=None):
+        self._class_name = class_name
+        self._parent = None
+        self._key = None
+        self._added = []
+        self._removed = []
+
+    def _bind(self, parent, key):
+        self._parent = parent
+        self._key = key
+        return self
+
+    def add(self, *objects):
+        for obj in objects:
+            self._class_name = self._class_name or obj.__class__.__name__
+            if obj in self._removed:
+                self._removed.remove(obj)
+            if obj not in self._added:
+                self._added.append(obj)
+
+    def remove(self, *objects):
+        for obj in objects:
+            if obj in self._added:
+                self._added.remove(obj)
+            if obj not in self._removed:
+                self._removed.append(obj)
+
+    def query(self):
+        """a Queryset of the objects in the relation"""
+        if self._parent is None or self._class_name is None:
+            raise ValueError('Relation is not attached to a saved object')
+        queryset = Object.factory(self._class_name).Query.all()
+        queryset._where['$relatedTo'] = {
+            'object': ParseType.convert_to_parse(self._parent,
+                                                 as_pointer=True),
+            'key': self._key
+            }
+        return queryset
+
+    def _saved(self):
+        self._added = []
+        self._removed = []
+
+    def _to_native(self):
+        ops = []
+        for op, objects in (('AddRelation', self._added),
+                            ('RemoveRelation', self._removed)):
+            if objects:
+                ops.append({'__op': op, 'objects': [
+                    ParseType.convert_to_parse(o, as_pointer=True)
+                    for o in objects]})
+        if len(ops) == 1:
+            return ops[0]
+        return {'__op': 'Batch', 'ops': ops}
 
 
 class Date(ParseType):
     FORMAT = '%Y-%m-%dT%H:%M:%S.%f%Z'
 
+    # the same timestamps come back over and over (createdAt/updatedAt of
+    # objects fetched repeatedly, pointers to the same object), so decoded
+    # values are memoized. datetimes are immutable, so sharing them is safe.
+    CACHE_SIZE = 1024
+    _cache = {}
+
     @classmethod
     def from_native(cls, **kw):
         return cls._from_str(kw.get('iso', ''))
@@ -114,33 +207,93 @@ class Date(ParseType):
     @staticmethod
     def _from_str(date_str):
         """turn a ISO 8601 string into a datetime object"""
+        date = Date._cache.get(date_str)
+        if date is None:
+            date = Date._parse(date_str)
+            if len(Date._cache) >= Date.CACHE_SIZE:
+                Date._cache.clear()
+            Date._cache[date_str] = date
+        return date
+
+    @staticmethod
+    def _parse(date_str):
+        """
+        Parse the fixed 'YYYY-MM-DDTHH:MM:SS.mmmZ' format used by Parse by
+        slicing the string, falling back to strptime for anything else
+        """
+        if len(date_str) == 24 and date_str[10] == 'T' and date_str[23] == 'Z':
+            try:
+                return datetime.datetime(
+                    int(date_str[0:4]), int(date_str[5:7]),
+                    int(date_str[8:10]), int(date_str[11:13]),
+                    int(date_str[14:16]), int(date_str[17:19]),
+                    int(date_str[20:23]) * 1000)
+            except ValueError:
+                pass
         return datetime.datetime.strptime(date_str[:-1] + 'UTC', Date.FORMAT)
 
     def __init__(self, date):
-        """Can be initialized either with a string or a datetime"""
+        """
+        Can be initialized either with a string or a datetime. Strings are
+        only parsed the first time the datetime is needed.
+        """
+        self._iso = None
+        self._datetime = None
         if isinstance(date, datetime.datetime):
-            self._date = date
-        elif isinstance(date, unicode):
-            self._date = Date._from_str(date)
+            self._datetime = date
+        elif isinstance(date, (str, unicode)):
+            self._iso = date
+
+    @property
+    def _date(self):
+        if self._datetime is None and self._iso is not None:
+            self._datetime = Date._from_str(self._iso)
+        return self._datetime
 
     def _to_native(self):
+        if self._datetime is None and self._iso is not None:
+            return {'__type': 'Date', 'iso': self._iso}
         return {
             '__type': 'Date', 'iso': self._date.isoformat()
             }
 
 
 class Binary(ParseType):
+    """
+    Bytes field. Only one representation is held at a time: data received
+    from Parse stays base64-encoded until it is read, and raw bytes are
+    only encoded when they are serialized.
+    """
 
     @classmethod
     def from_native(cls, **kw):
         return cls(kw.get('base64', ''))
 
+    @classmethod
+    def from_bytes(cls, data):
+        """wrap raw bytes (or a bytearray/memoryview) without copying them"""
+        binary = cls(None)
+        binary._decoded = data
+        return binary
+
     def __init__(self, encoded_string):
         self._encoded = encoded_string
-        self._decoded = str(base64.b64decode(self._encoded))
+        self._decoded = None
+
+    def _get_data(self):
+        if self._decoded is None and self._encoded is not None:
+            self._decoded = base64.b64decode(self._encoded)
+            self._encoded = None
+        return self._decoded
 
     def _to_native(self):
-        return {'__type': 'Bytes', 'base64': self._encoded}
+        encoded = self._encoded
+        if encoded is None:
+            encoded = base64.b64encode(self._decoded).decode('ascii')
+        return {'__type': 'Bytes', 'base64': encoded}
+
+    data = property(_get_data)
+    view = property(lambda self: memoryview(self.data))
 
 
 class GeoPoint(ParseType):
@@ -162,17 +315,91 @@ class GeoPoint(ParseType):
 
 
 class File(ParseType):
+    # size of the blocks files are read and written in when streaming
+    CHUNK_SIZE = 64 * 1024
+    # local files at least this big are memory-mapped for uploading
+    MMAP_THRESHOLD = 1024 * 1024
 
     @classmethod
     def from_native(cls, **kw):
         return cls(**kw)
 
+    @classmethod
+    def upload(cls, source, name=None, content_type=None):
+        """
+        Upload a file to Parse and return a File pointing to it. source is
+        either a path or a file object opened in binary mode. Its contents
+        are streamed instead of being read into memory.
+        """
+        if isinstance(source, (str, unicode)):
+            with open(source, 'rb') as fileobj:
+                return cls._upload(fileobj, name or os.path.basename(source),
+                                   content_type)
+        name = name or os.path.basename(getattr(source, 'name', 'file'))
+        return cls._upload(source, name, content_type)
+
+    @classmethod
+    def upload_many(cls, sources, concurrency=None):
+        """upload several files in parallel, returning Files in order"""
+        return parallel_map(cls.upload, sources, concurrency)
+
+    @classmethod
+    def _upload(cls, fileobj, name, content_type=None):
+        content_type = (content_type or mimetypes.guess_type(name)[0] or
+                        'application/octet-stream')
+        start = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell() - start
+        fileobj.seek(start)
+
+        body, mapped = fileobj, None
+        if size >= cls.MMAP_THRESHOLD:
+            try:
+                mapped = mmap.mmap(fileobj.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            except (AttributeError, ValueError, EnvironmentError):
+                pass  # not a regular file on disk; stream it as it is
+            else:
+                mapped.seek(start)
+                body = mapped
+
+        uri = '/'.join([API_ROOT, 'files', quote(name)])
+        try:
+            response = ParseBase.execute_stream(uri, 'POST', body,
+                                                content_type, size)
+        finally:
+            if mapped is not None:
+                mapped.close()
+        return cls(**response)
+
     def __init__(self, **kw):
         name = kw.get('name')
         self._name = name
         self._api_url = '/'.join([API_ROOT, 'files', name])
         self._file_url = kw.get('url')
 
+    def download(self, dest):
+        """
+        Stream the file's contents into dest, either a path or a file
+        object opened in binary mode, without holding it all in memory
+        """
+        response = urlopen(self._file_url)
+        try:
+            if isinstance(dest, (str, unicode)):
+                with open(dest, 'wb') as fileobj:
+                    self._copy(response, fileobj)
+            else:
+                self._copy(response, dest)
+        finally:
+            response.close()
+
+    def _copy(self, response, fileobj):
+        while True:
+            chunk = response.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            fileobj.write(chunk)
+
     def _to_native(self):
         return {
             '__type': 'File',
@@ -184,28 +411,63 @@ class File(ParseType):
     _absolute_url = property(lambda self: self._api_url)
 
 
-class ParseM2M(Relation):
-    def convert_from_parse(parse_data):
-        pass
-
-    def convert_to_parse(python_object, as_pointer=False):
-        pass
+# kept for backwards compatibility
+ParseM2M = Relation
 
 
 class Function(ParseBase):
     ENDPOINT_ROOT = '/'.join((API_ROOT, 'functions'))
 
-    def __init__(self, name):
+    def __init__(self, name, client=None, idempotent=False, ttl=60):
+        """
+        client runs the function, by default the current client. The
+        responses of an idempotent function are cached by the client for
+        ttl seconds, per arguments and user session.
+        """
         self.name = name
+        self.client = client
+        self.idempotent = idempotent
+        self.ttl = ttl
 
     def __call__(self, **kwargs):
-        return self.POST('/' + self.name, **kwargs)
+        with self.client or ParseClient.current() as client:
+            if not self.idempotent:
+                return self.POST('/' + self.name, **kwargs)
+
+            key = (self.name, Session.current_token(),
+                   json.dumps(kwargs, sort_keys=True))
+            response = client.function_results.get(key)
+            if response is None:
+                response = self.POST('/' + self.name, **kwargs)
+                client.function_results.set(key, response, self.ttl)
+            # the caller may modify the response
+            return copy.deepcopy(response)
+
+    def map(self, calls, concurrency=None):
+        """
+        Call the function once per dict of keyword arguments in calls,
+        concurrently. Returns the responses in the order of calls, with
+        the exception raised in place of the response of a failed call.
+        """
+        def call(kwargs):
+            try:
+                return self(**kwargs)
+            except Exception as e:
+                return e
+
+        with self.client or ParseClient.current():
+            return parallel_map(call, calls, concurrency)
 
 
 class ParseResource(ParseBase, Pointer):
 
     PROTECTED_ATTRIBUTES = ['objectId', 'createdAt', 'updatedAt']
 
+    # when True, fields holding Parse types (pointers, dates, bytes...) are
+    # kept as the JSON returned by Parse and only converted the first time
+    # they are read. Fields that are never read are saved back untouched.
+    LAZY_DECODING = False
+
     def __eq__(self, other):
         if not isinstance(other, ParseResource):
             return False
@@ -216,22 +478,114 @@ class ParseResource(ParseBase, Pointer):
             return self is other
         return self.objectId == other.objectId
 
+    # longest where clause sent when looking objects up by objectId, in
+    # URL encoded characters, to keep the query string within common URL
+    # length limits
+    MAX_WHERE_LENGTH = 4000
+
     @classmethod
     def retrieve(cls, resource_id):
         return cls(**cls.GET('/' + resource_id))
 
+    @classmethod
+    def retrieve_many(cls, resource_ids, concurrency=None):
+        """
+        Retrieve objects by objectId with as few objectId__in queries as
+        the URL length allows, run concurrently. Returns the objects in
+        the order of resource_ids, with None for the ids not found.
+        """
+        manager = query.QueryManager(cls)
+
+        def fetch(ids):
+            return manager.filter(objectId__in=ids)._fetch(limit=len(ids))
+
+        found = {}
+        for objects in parallel_map(fetch, cls._in_chunks(resource_ids),
+                                    concurrency):
+            found.update([(o.objectId, o) for o in objects])
+        return [found.get(resource_id) for resource_id in resource_ids]
+
+    @classmethod
+    def _in_chunks(cls, values, encode=None):
+        """
+        Split the distinct strings in values into chunks small enough for
+        a field__in query, both in URL length and in number of results.
+        encode turns a value into what the query holds for it (such as a
+        pointer), if that isn't the value itself.
+        """
+        unique_values = []
+        seen = set()
+        for value in values:
+            if value not in seen:
+                seen.add(value)
+                unique_values.append(value)
+
+        chunks, chunk, length = [], [], 0
+        for value in unique_values:
+            encoded = encode and encode(value) or value
+            # the value as it is sent in the URL, and the comma after it
+            value_length = len(quote_plus(json.dumps(encoded))) + 4
+            if chunk and (length + value_length > cls.MAX_WHERE_LENGTH or
+                          len(chunk) == query.Queryset.MAX_PAGE_SIZE):
+                chunks.append(chunk)
+                chunk, length = [], 0
+            chunk.append(value)
+            length += value_length
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
     @property
     def _editable_attrs(self):
         protected_attrs = self.__class__.PROTECTED_ATTRIBUTES
         allowed = lambda a: a not in protected_attrs and not a.startswith('_')
-        return dict([(k, v) for k, v in self.__dict__.items() if allowed(k)])
+        attrs = dict(self.__dict__.get('_raw_fields', {}))
+        attrs.update(self.__dict__)
+        return dict([(k, v) for k, v in attrs.items() if allowed(k)])
 
     def __init__(self, **kw):
+        # objects created while a client is active keep using it
+        client = ParseClient._active()
+        if client is not None:
+            self._client = client
+        lazy = self.__class__.LAZY_DECODING
         for key, value in kw.items():
-            setattr(self, key, ParseType.convert_from_parse(value))
+            if lazy and isinstance(value, dict) and '__type' in value:
+                self.__dict__.pop(key, None)
+                self.__dict__.setdefault('_raw_fields', {})[key] = value
+            else:
+                setattr(self, key, self._convert_field(key, value))
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails: decode a lazy field and
+        # cache the converted value as a regular attribute
+        raw_fields = self.__dict__.get('_raw_fields')
+        if not raw_fields or name not in raw_fields:
+            raise AttributeError("'%s' object has no attribute '%s'" % (
+                self.__class__.__name__, name))
+        value = self._convert_field(name, raw_fields.pop(name))
+        setattr(self, name, value)
+        return value
+
+    def _convert_field(self, key, value):
+        value = ParseType.convert_from_parse(value)
+        if isinstance(value, Relation):
+            value._bind(self, key)
+        return value
 
     def _to_native(self):
-        return ParseType.convert_to_parse(self)
+        """the fields to save, with other objects as pointers"""
+        return dict([(k, ParseType.convert_to_parse(v, as_pointer=True))
+                     for k, v in self._editable_attrs.items()
+                     if not Relation._is_unchanged(v)])
+
+    def _pointer_id(self, key):
+        """objectId a pointer field refers to, without fetching the object"""
+        raw = self.__dict__.get('_raw_fields', {}).get(key)
+        if raw is not None:
+            return raw.get('objectId')
+        value = getattr(self, key, None)
+        return value and value.objectId
 
     def _get_object_id(self):
         return self.__dict__.get('_object_id')
@@ -253,12 +607,78 @@ class ParseResource(ParseBase, Pointer):
     def _set_created_datetime(self, value):
         self._created_at = Date(value)
 
-    def save(self, batch=False, **kwargs):
+    def save(self, batch=False, cascade=False, **kwargs):
+        """
+        Create or update the object. With cascade=True, new objects it
+        points to (directly or through other new objects) are created
+        first, one batch per level of the graph.
+        """
+        unit_of_work = UnitOfWork.current()
+        if unit_of_work is not None and not batch:
+            return unit_of_work.save(self)
+
+        if cascade and not batch:
+            for level in ParseResource._save_levels([self])[:-1]:
+                _raise_batch_errors(level, ParseBatcher().batch_save(level))
+
+        # the fields sent already include the effect of atomic operations
+        # pending on the object, so sending those as well would apply them
+        # twice
+        buffer = AtomicOpsBuffer.current()
+        if buffer is not None:
+            buffer.take(self)
+
         if self.objectId:
             return self._update(batch=batch)
         else:
             return self._create(batch=batch)
 
+    def _relations_saved(self):
+        for value in self.__dict__.values():
+            if isinstance(value, Relation):
+                value._saved()
+
+    def _unsaved_references(self):
+        """objects this one points to that have not been created yet"""
+        return [v for v in self._editable_attrs.values()
+                if isinstance(v, ParseResource) and v.objectId is None
+                and v is not self]
+
+    @staticmethod
+    def _save_levels(objects):
+        """
+        Split objects, and the new objects they point to, into levels such
+        that objects only point to new objects of earlier levels. Each
+        level can then be saved in a single batch.
+        """
+        depths = {}
+        visiting = set()
+        order = []
+
+        def depth(obj):
+            key = id(obj)
+            if key in depths:
+                return depths[key]
+            if key in visiting:
+                raise core.ParseError(
+                    'Can not save a cycle of new objects pointing to '
+                    'each other')
+            visiting.add(key)
+            references = obj._unsaved_references()
+            depths[key] = max([depth(r) + 1 for r in references] or [0])
+            visiting.discard(key)
+            order.append(obj)
+            return depths[key]
+
+        for obj in objects:
+            depth(obj)
+
+        levels = [[] for _ in range(max(depths.values() or [-1]) + 1)]
+        for obj in order:
+            levels[depths[id(obj)]].append(obj)
+        return levels
+
+    @with_client
     def _create(self, batch=False):
         uri = self.__class__.ENDPOINT_ROOT
         response = self.__class__.POST(uri, batch=batch, **self._to_native())
@@ -266,25 +686,38 @@ class ParseResource(ParseBase, Pointer):
         def call_back(response_dict):
             self.createdAt = self.updatedAt = response_dict['createdAt']
             self.objectId = response_dict['objectId']
+            self._relations_saved()
 
         if batch:
             return response, call_back
         else:
             call_back(response)
 
-    def _update(self, batch=False):
+    @with_client
+    def _update(self, batch=False, fields=None):
+        """send the object's fields, or only the given native fields"""
+        saving_relations = fields is None
+        if fields is None:
+            fields = self._to_native()
         response = self.__class__.PUT(self._absolute_url, batch=batch,
-                                      **self._to_native())
+                                      **fields)
 
         def call_back(response_dict):
             self.updatedAt = response_dict['updatedAt']
+            if saving_relations:
+                self._relations_saved()
 
         if batch:
             return response, call_back
         else:
             call_back(response)
 
+    @with_client
     def delete(self, batch=False):
+        unit_of_work = UnitOfWork.current()
+        if unit_of_work is not None and not batch:
+            return unit_of_work.delete(self)
+
         response = self.__class__.DELETE(self._absolute_url, batch=batch)
         def call_back(response_dict):
             self.__dict__ = {}
@@ -439,6 +872,14 @@ class Object(ParseResource):
         if not self.objectId: return None
         return '/'.join([self.__class__.ENDPOINT_ROOT, self.objectId])
 
+    def relation(self, key):
+        """the Relation stored in the field key, created if it is missing"""
+        value = getattr(self, key, None)
+        if not isinstance(value, Relation):
+            value = Relation()
+            setattr(self, key, value)
+        return value._bind(self, key)
+
     @property
     def as_pointer(self):
         return Pointer(**{
@@ -449,13 +890,35 @@ class Object(ParseResource):
     def increment(self, key, amount=1):
         """
         Increment one value in the object. Note that this happens immediately:
-        it does not wait for save() to be called
+        it does not wait for save() to be called (but see AtomicOpsBuffer)
         """
-        payload = {
-            key: {
-                '__op': 'Increment',
-                'amount': amount
-                }
-            }
-        self.__class__.PUT(self._absolute_url, **payload)
+        self._atomic_op(key, {'__op': 'Increment', 'amount': amount})
         self.__dict__[key] += amount
+
+    def add_to_array(self, key, objects):
+        """append objects to an array field, immediately like increment"""
+        self._atomic_op(key, {'__op': 'Add', 'objects': objects})
+        self.__dict__.setdefault(key, []).extend(objects)
+
+    def add_unique_to_array(self, key, objects):
+        """add the objects not already in an array field"""
+        self._atomic_op(key, {'__op': 'AddUnique', 'objects': objects})
+        values = self.__dict__.setdefault(key, [])
+        values.extend([o for o in objects if o not in values])
+
+    def remove_from_array(self, key, objects):
+        """remove every occurrence of objects from an array field"""
+        self._atomic_op(key, {'__op': 'Remove', 'objects': objects})
+        self.__dict__[key] = [
+            o for o in self.__dict__.get(key, []) if o not in objects]
+
+    @with_client
+    def _atomic_op(self, key, op):
+        if 'objects' in op:
+            op['objects'] = [ParseType.convert_to_parse(o, as_pointer=True)
+                             for o in op['objects']]
+        buffer = AtomicOpsBuffer.current()
+        if buffer is not None:
+            buffer.add(self, key, op)
+        else:
+            self.__class__.PUT(self._absolute_url, **{key: op})
@@ -11,18 +11,109 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from connection import API_ROOT
-from datatypes import ParseResource
+import collections
+import functools
+import json
+import time
+
+from connection import API_ROOT, ParseBatcher, parallel_map
+from datatypes import ParseResource, ParseType
 from query import QueryManager
 
 
 class Installation(ParseResource):
     ENDPOINT_ROOT = '/'.join([API_ROOT, 'installations'])
 
+    @classmethod
+    def bulk_upsert(cls, installations, key='deviceToken', concurrency=None):
+        """
+        Create or update many installations, given as dicts of fields
+        identified by key (deviceToken or installationId). When several
+        have the same key, their fields are merged, the later ones taking
+        precedence. Existing installations are looked up with a few
+        key__in queries, and only their changed fields are sent, in
+        batches run concurrently. When several saved installations have
+        the same key, the latest one is updated and the others deleted.
+
+        Returns a dict of the number of installations created, updated,
+        unchanged and deleted, and of the errors of those that failed, by
+        key.
+        """
+        merged = collections.OrderedDict()
+        for fields in installations:
+            if fields.get(key) is None:
+                raise ValueError('Installation without a %s' % key)
+            merged.setdefault(fields[key], {}).update(fields)
+
+        def fetch(values):
+            qs = cls.Query.filter(**{key + '__in': values})
+            return [o for page in qs._scan() for o in page]
+
+        existing, duplicates = {}, []
+        chunks = cls._in_chunks(list(merged.keys()))
+        for objects in parallel_map(fetch, chunks, concurrency):
+            for obj in objects:
+                # duplicates already saved: update the latest one and
+                # delete the others
+                value = getattr(obj, key)
+                latest = existing.get(value)
+                if latest is None:
+                    existing[value] = obj
+                    continue
+                if latest.updatedAt < obj.updatedAt:
+                    latest, obj = obj, latest
+                existing[value] = latest
+                duplicates.append(obj)
+
+        methods = [o.delete for o in duplicates]
+        keys = [getattr(o, key) for o in duplicates]
+        unchanged = 0
+        for value, fields in merged.items():
+            obj = existing.get(value)
+            if obj is None:
+                obj = cls(**fields)
+                methods.append(obj._create)
+                keys.append(value)
+                continue
+            current = obj._to_native()
+            changed = {}
+            for name, field in fields.items():
+                native = ParseType.convert_to_parse(field, as_pointer=True)
+                if current.get(name) != native:
+                    changed[name] = native
+                    setattr(obj, name, field)
+            if changed:
+                methods.append(functools.partial(obj._update, fields=changed))
+                keys.append(value)
+            else:
+                unchanged += 1
+
+        batcher = ParseBatcher()
+        size = batcher.BATCH_SIZE
+        chunks = [methods[i:i + size] for i in range(0, len(methods), size)]
+        results = [r for chunk in parallel_map(batcher.batch, chunks,
+                                               concurrency) for r in chunk]
+
+        counts = {'created': 0, 'updated': 0, 'unchanged': unchanged,
+                  'deleted': 0, 'failed': {}}
+        for i, (value, result) in enumerate(zip(keys, results)):
+            if not result.ok:
+                counts['failed'][value] = result.error
+            elif i < len(duplicates):
+                counts['deleted'] += 1
+            elif value in existing:
+                counts['updated'] += 1
+            else:
+                counts['created'] += 1
+        return counts
+
 
 class Push(ParseResource):
     ENDPOINT_ROOT = '/'.join([API_ROOT, 'push'])
 
+    # the most where queries send_many combines into one push's $or
+    MAX_OR_CLAUSES = 50
+
     @classmethod
     def _send(cls, data, where=None, **kw):
         if where: kw['where'] = where
@@ -36,4 +127,74 @@ class Push(ParseResource):
     def message(cls, message, where=None, **kw):
         cls._send({'alert': message}, where=where, **kw)
 
+    @classmethod
+    def send_many(cls, pushes, concurrency=None):
+        """
+        Send many pushes concurrently. Each push is a dict of the
+        arguments of _send: data, where or channels, and any other push
+        option. Pushes with the same data and options are sent together,
+        to the union of their channels or to installations matching any
+        of their where queries (up to MAX_OR_CLAUSES of them per send).
+
+        Returns, for each push, the response of the send it went out with
+        (or the exception that send raised), and a dict of stats: the
+        number of pushes, of sends, of failed sends, the time taken in
+        seconds and the pushes sent per second.
+        """
+        groups = collections.OrderedDict()
+        for index, push in enumerate(pushes):
+            options = dict(push)
+            where = options.pop('where', None)
+            channels = options.pop('channels', None)
+            if where is not None and channels is not None:
+                raise ValueError('push %d has both where and channels' % index)
+            if where is not None:
+                target = 'where'
+            elif channels is not None:
+                target = 'channels'
+            else:
+                target = None
+            key = (target, json.dumps(options, sort_keys=True))
+            group = groups.setdefault(key, (target, options, [], []))
+            group[2].append(index)
+            group[3].append(where if target == 'where' else channels)
+
+        sends = []
+        for target, options, indexes, targets in groups.values():
+            size = target == 'where' and cls.MAX_OR_CLAUSES or len(targets)
+            for i in range(0, len(targets), size):
+                sends.append((target, options, indexes[i:i + size],
+                              targets[i:i + size]))
+
+        def send(group):
+            target, options, _, targets = group
+            kw = dict(options)
+            data = kw.pop('data')
+            where = None
+            if target == 'where':
+                where = len(targets) == 1 and targets[0] or {'$or': targets}
+            elif target == 'channels':
+                kw['channels'] = sorted(set(c for t in targets for c in t))
+            try:
+                return cls._send(data, where=where, **kw)
+            except Exception as e:
+                return e
+
+        start = time.time()
+        responses = parallel_map(send, sends, concurrency)
+        seconds = time.time() - start
+
+        results = [None] * len(pushes)
+        for group, response in zip(sends, responses):
+            for index in group[2]:
+                results[index] = response
+        stats = {
+            'pushes': len(pushes),
+            'sends': len(responses),
+            'failed': len([r for r in responses if isinstance(r, Exception)]),
+            'seconds': seconds,
+            'per_second': seconds and len(pushes) / seconds,
+            }
+        return results, stats
+
 Installation.Query = QueryManager(Installation)
@@ -14,6 +14,9 @@
 import json
 import collections
 import copy
+import functools
+import multiprocessing
+import string
 import connection
 
 try:
@@ -21,6 +24,154 @@ try:
 except NameError:
     unicode = str
 
+def _map_partition(job):
+    """call a map_partitions function on the objects of one partition"""
+    queryset, func, page_size = job
+    return func(obj for page in queryset._scan(page_size) for obj in page)
+
+
+class Accumulator(object):
+    """
+    Folds the values of a field of the objects matching a query into a
+    result (see Queryset.aggregate). The fold keeps a state: subclasses
+    define start(), returning a new one, add(state, value), adding a value
+    to one, and merge(state, other), combining the states of two sets of
+    objects; result() turns one into the result. Objects without a value
+    for the field are skipped, and the value of a pointer is the objectId
+    of the object it points to.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def result(self, state):
+        return state
+
+
+class Sum(Accumulator):
+    def start(self):
+        return 0
+
+    def add(self, state, value):
+        return state + value
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Count(Accumulator):
+    """the number of objects, or of those with a value for field"""
+
+    def __init__(self, field=None):
+        super(Count, self).__init__(field)
+
+    def start(self):
+        return 0
+
+    def add(self, state, value):
+        return state + 1
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Min(Accumulator):
+    def start(self):
+        return None
+
+    def add(self, state, value):
+        return value if state is None or value < state else state
+
+    def merge(self, state, other):
+        return state if other is None else self.add(state, other)
+
+
+class Max(Accumulator):
+    def start(self):
+        return None
+
+    def add(self, state, value):
+        return value if state is None or value > state else state
+
+    def merge(self, state, other):
+        return state if other is None else self.add(state, other)
+
+
+class Avg(Accumulator):
+    def start(self):
+        return (0, 0)
+
+    def add(self, state, value):
+        return (state[0] + value, state[1] + 1)
+
+    def merge(self, state, other):
+        return (state[0] + other[0], state[1] + other[1])
+
+    def result(self, state):
+        total, count = state
+        return total / float(count) if count else None
+
+
+class Histogram(Accumulator):
+    """
+    the number of objects by value of field, or by bucket of width values
+    (the buckets being keyed by their lowest value)
+    """
+
+    def __init__(self, field, width=None):
+        super(Histogram, self).__init__(field)
+        self.width = width
+
+    def start(self):
+        return {}
+
+    def add(self, state, value):
+        if self.width:
+            value = (value // self.width) * self.width
+        state[value] = state.get(value, 0) + 1
+        return state
+
+    def merge(self, state, other):
+        for value, count in other.items():
+            state[value] = state.get(value, 0) + count
+        return state
+
+
+def _fold(objects, group, accumulators):
+    """
+    the states of accumulators folded over objects, by value of the group
+    field (or under None)
+    """
+    states = {}
+    for obj in objects:
+        key = group and _field_value(obj, group)
+        # group pointers by the objectId of the object they point to
+        key = getattr(key, 'objectId', key)
+        state = states.get(key)
+        if state is None:
+            state = states[key] = dict(
+                (name, a.start()) for name, a in accumulators.items())
+        for name, accumulator in accumulators.items():
+            if accumulator.field is None:
+                value = obj
+            else:
+                value = _field_value(obj, accumulator.field)
+            if value is not None:
+                state[name] = accumulator.add(state[name], value)
+    return states
+
+
+def _field_value(obj, field):
+    """
+    the value of field on obj, or the objectId of a pointer left undecoded,
+    which reading would fetch the object it points to
+    """
+    raw = obj.__dict__.get('_raw_fields', {}).get(field)
+    if raw is not None and raw.get('__type') == 'Pointer':
+        return raw.get('objectId')
+    return getattr(obj, field, None)
+
+
 class QueryResourceDoesNotExist(Exception):
     '''Query returned no results'''
     pass
@@ -33,30 +184,60 @@ class QueryResourceMultipleResultsReturned(Exception):
 
 class QueryManager(object):
 
-    def __init__(self, model_class):
+    def __init__(self, model_class, client=None):
         self.model_class = model_class
+        # queries are sent with this client, by default the current one
+        self.client = client
 
     def _fetch(self, **kw):
-        klass = self.model_class
-        uri = self.model_class.ENDPOINT_ROOT
-        return [klass(**it) for it in klass.GET(uri, **kw).get('results')]
+        with self.client or connection.ParseClient.current():
+            klass = self.model_class
+            uri = self.model_class.ENDPOINT_ROOT
+            results = klass.GET(uri, **kw).get('results')
+            if not klass.LAZY_DECODING:
+                self._resolve_pointers(results)
+            return [klass(**it) for it in results]
+
+    @staticmethod
+    def _resolve_pointers(results):
+        """
+        Replace the pointers in a page of results with the objects they
+        point to, fetched with one retrieve_many per class rather than one
+        request per pointer. Pointers to missing objects are left as they
+        are.
+        """
+        from datatypes import Object
+        pointers = collections.defaultdict(list)
+        for row in results:
+            for key, value in row.items():
+                if isinstance(value, dict) and value.get('__type') == 'Pointer':
+                    pointers[value.get('className')].append((row, key))
+
+        for class_name, references in pointers.items():
+            klass = Object.factory(class_name)
+            objects = klass.retrieve_many(
+                [row[key]['objectId'] for row, key in references])
+            for (row, key), obj in zip(references, objects):
+                if obj is not None:
+                    row[key] = obj
 
     def _count(self, **kw):
         kw.update({"count": 1, "limit": 0})
-        return self.model_class.GET(self.model_class.ENDPOINT_ROOT,
+        with self.client or connection.ParseClient.current():
+            return self.model_class.GET(self.model_class.ENDPOINT_ROOT,
                                         **kw).get('count')
 
     def all(self):
         return Queryset(self)
 
-    def filter(self, **kw):
-        return self.all().filter(**kw)
+    def filter(self, *args, **kw):
+        return self.all().filter(*args, **kw)
 
     def fetch(self):
         return self.all().fetch()
 
-    def get(self, **kw):
-        return self.filter(**kw).get()
+    def get(self, *args, **kw):
+        return self.filter(*args, **kw).get()
 
     def create(self, **kwargs):
         instance = self.model_class(**kwargs)
@@ -69,9 +250,11 @@ class M2MQueryManager(QueryManager):
     def __init__(self, from_class, to_class, instance, joint_class=None):
         from datatypes import Object
         if not joint_class:
+            # joint rows only hold pointers, which are left undecoded so
+            # reading them doesn't fetch the objects they point to
             joint_class = type(
                 "%s%ss" % (from_class.__name__, to_class.__name__),
-                (Object,), {}
+                (Object,), {'LAZY_DECODING': True}
             )
         self.from_class = from_class
         self.to_class = to_class
@@ -80,25 +263,57 @@ class M2MQueryManager(QueryManager):
         super(M2MQueryManager, self).__init__(to_class)
     
     def all(self):
-        related = self.joint_class.Query.filter(
-            **{ self._from_relation: self.instance }
-        )
-        return self.to_class.Query.filter(objectId__in=[
-            getattr(inst, self._to_relation).objectId for inst in related])
+        # match the related objects against the pointers of this instance's
+        # joint rows with a $select subquery, so only one request is needed
+        from datatypes import ParseType
+        instance = ParseType.convert_to_parse(self.instance, as_pointer=True)
+        return self.to_class.Query.filter(objectId__select={
+            'query': {
+                'className': self.joint_class.__name__,
+                'where': {self._from_relation: instance},
+            },
+            'key': '%s.objectId' % self._to_relation,
+        })
 
     def add(self, *args):
-        instances = [self.joint_class(
+        # skip objects that are already related, found with as few queries
+        # as the length of the pointers in their URLs allows
+        related_ids = set()
+        saved = dict([(instance.objectId, instance) for instance in args
+                      if instance.objectId])
+        pointer = lambda i: Queryset.convert_to_parse(saved[i])
+        for chunk in self.to_class._in_chunks(list(saved), pointer):
+            related = self._joint_rows().filter(
+                **{'%s__in' % self._to_relation: [saved[i] for i in chunk]}
+            ).only(self._to_relation)
+            for page in related._scan():
+                related_ids.update(
+                    [row._pointer_id(self._to_relation) for row in page])
+
+        instances = []
+        for instance in args:
+            if instance.objectId in related_ids:
+                continue
+            if instance.objectId:
+                related_ids.add(instance.objectId)
+            instances.append(self.joint_class(
                 **{
                     self._from_relation: self.instance,
                     self._to_relation: instance,
                 }
-            ) for instance in args
-        ]
+            ))
         batcher = connection.ParseBatcher()
         batcher.batch_save(instances)
 
     def clear(self, *args):
-        self.joint_class.Query.all().delete()
+        self._joint_rows().delete()
+
+    def _joint_rows(self):
+        return self.joint_class.Query.filter(
+            **{self._from_relation: self.instance})
+
+    def count(self):
+        return self.all().count()
 
     def exists(self):
         return self.all().exists()
@@ -112,6 +327,124 @@ class M2MQueryManager(QueryManager):
         return self.to_class.__name__.lower()
 
 
+def _is_operators(value):
+    """whether a where clause value is a dict of operators ($lt, ...)"""
+    return isinstance(value, dict) and all(
+        key.startswith('$') for key in value)
+
+
+def _merge_where(where, other):
+    """
+    where and other combined: objects have to meet the constraints of
+    both. Bounds on the same field are tightened ($gt/$gte to the higher,
+    $lt/$lte to the lower, $in to the values in both) and an equality on
+    a field that other constraints apply to becomes an $eq operator.
+    Otherwise, as when chaining filters, other's constraint wins.
+    """
+    merged = dict(where)
+    for key, value in other.items():
+        current = merged.get(key)
+        if (key not in merged or current == value or
+                not (_is_operators(current) or _is_operators(value))):
+            merged[key] = value
+            continue
+        if not _is_operators(current):
+            current = {'$eq': current}
+        if not _is_operators(value):
+            value = {'$eq': value}
+        combined = dict(current)
+        for operator, operand in value.items():
+            if operator in current:
+                operand = _merge_operand(operator, current[operator], operand)
+            combined[operator] = operand
+        merged[key] = combined
+    return merged
+
+
+def _merge_operand(operator, current, other):
+    """the operand of operator meeting both current and other"""
+    # compare dates by their ISO strings
+    comparable = lambda v: v.get('iso', v) if isinstance(v, dict) else v
+    if operator in ('$gt', '$gte'):
+        return max(current, other, key=comparable)
+    if operator in ('$lt', '$lte'):
+        return min(current, other, key=comparable)
+    if operator == '$in':
+        return [v for v in current if v in other]
+    if operator in ('$nin', '$all'):
+        return current + [v for v in other if v not in current]
+    return other
+
+
+class Q(object):
+    """
+    Constraints given like the keyword arguments of Queryset.filter, that
+    can be combined with | (or) and & (and) before filtering with them. An
+    or is sent to Parse as a single $or query:
+
+        GameScore.Query.filter(Q(score__gte=1000) | Q(player_name='Joe'))
+    """
+
+    def __init__(self, **kw):
+        # the where clauses matching any of which matches the Q
+        self.alternatives = [Queryset._constraints(kw)]
+
+    @classmethod
+    def _from_alternatives(cls, alternatives):
+        q = cls()
+        q.alternatives = alternatives
+        return q
+
+    @classmethod
+    def _from_where(cls, where):
+        where = dict(where)
+        alternatives = where.pop('$or', None)
+        if alternatives is None:
+            return cls._from_alternatives([where])
+        return cls._from_alternatives(
+            [_merge_where(where, a) for a in alternatives])
+
+    def __or__(self, other):
+        return Q._from_alternatives(self.alternatives + other.alternatives)
+
+    def __and__(self, other):
+        return Q._from_alternatives([_merge_where(a, b)
+                                     for a in self.alternatives
+                                     for b in other.alternatives])
+
+    def _where(self):
+        """the where clause, with constraints common to every alternative
+        kept out of the $or"""
+        first = self.alternatives[0]
+        if len(self.alternatives) == 1:
+            return dict(first)
+        common = dict([(k, v) for k, v in first.items() if all(
+            k in a and a[k] == v for a in self.alternatives[1:])])
+        alternatives = [dict([(k, v) for k, v in a.items() if k not in common])
+                        for a in self.alternatives]
+        where = dict(common)
+        if all(alternatives):
+            # otherwise an alternative with no other constraints matches
+            # anything the common constraints do
+            where['$or'] = alternatives
+        return where
+
+
+class GroupBy(object):
+    """the objects matching a query grouped by a field (Queryset.group_by)"""
+
+    def __init__(self, queryset, field):
+        self.queryset = queryset
+        self.field = field
+
+    def aggregate(self, partitions=None, **accumulators):
+        """
+        Like Queryset.aggregate, but compute the aggregates of each group,
+        returning a dict of their results by value of the field
+        """
+        return self.queryset._aggregate(self.field, accumulators, partitions)
+
+
 class QuerysetMetaclass(type):
     """metaclass to add the dynamically generated comparison functions"""
     def __new__(cls, name, bases, dct):
@@ -131,12 +464,30 @@ class Queryset(object):
     __metaclass__ = QuerysetMetaclass
 
     OPERATORS = [
-        'lt', 'lte', 'gt', 'gte', 'ne', 'in', 'nin', 'exists', 'select', 'dontSelect', 'all'
+        'lt', 'lte', 'gt', 'gte', 'ne', 'in', 'nin', 'exists', 'select', 'dontSelect', 'all',
+        'nearSphere', 'maxDistance', 'maxDistanceInMiles', 'maxDistanceInKilometers',
+        'maxDistanceInRadians', 'within'
         ]
 
+    # atomic operations update() accepts, as field__operation=value
+    UPDATE_OPERATORS = {
+        'increment': 'Increment',
+        'add': 'Add',
+        'add_unique': 'AddUnique',
+        'remove': 'Remove',
+        }
+
+    # the most objects Parse returns for a single query
+    MAX_PAGE_SIZE = 1000
+
+    # the characters Parse generates objectIds from, in sort order
+    OBJECT_ID_CHARS = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
     @staticmethod
     def convert_to_parse(value):
         from datatypes import ParseType
+        if isinstance(value, (list, tuple)):
+            return [Queryset.convert_to_parse(v) for v in value]
         return ParseType.convert_to_parse(value, as_pointer=True)
 
     @classmethod
@@ -160,12 +511,14 @@ class Queryset(object):
         # Figure out slicing and indexing on parse.com if possible...
         return self._fetch()[k]
 
-    def _fetch(self, count=False):
+    def _fetch(self, count=False, **extra):
         """
         Return a list of objects matching query, or if count == True return
-        only the number of objects matching.
+        only the number of objects matching. Keyword arguments override the
+        queryset's options for this request only.
         """
         options = dict(self._options)  # make a local copy
+        options.update(extra)
         if self._where:
             # JSON encode WHERE values
             where = json.dumps(self._where)
@@ -175,14 +528,266 @@ class Queryset(object):
 
         return self._manager._fetch(**options)
 
-    def filter(self, **kw):
+    def iterator(self, page_size=None, prefetch=0):
+        """
+        Iterate over every object matching the query, however many there
+        are, fetching them a page at a time. With prefetch, up to that
+        many pages are fetched ahead on a background thread while the
+        current page is being consumed.
+        """
+        # scanning by objectId would lose the order and the skip
+        if self._ordered():
+            pages = self._pages(page_size)
+        else:
+            pages = self._scan(page_size)
+        if prefetch:
+            pages = connection.prefetch(pages, prefetch)
+        for page in pages:
+            for obj in page:
+                yield obj
+
+    def _ordered(self):
+        """
+        whether the queryset's order or skip decide which objects it
+        matches, so that they can't be scanned by objectId
+        """
+        return ('order' in self._options or 'skip' in self._options or
+                self._sorted_by_distance())
+
+    def _sorted_by_distance(self):
+        """whether Parse sorts the results by distance ($nearSphere)"""
+        return any(_is_operators(value) and '$nearSphere' in value
+                   for value in self._where.values())
+
+    def _pages(self, page_size=None, keys=None):
+        """
+        Yield every object matching the query one page at a time, using
+        skip, in the queryset's order and honoring its skip and limit
+        """
+        extra = keys is not None and {'keys': keys} or {}
+        page_size = page_size or self.MAX_PAGE_SIZE
+        skip = self._options.get('skip', 0)
+        remaining = self._options.get('limit')
+        while remaining is None or remaining > 0:
+            limit = page_size
+            if remaining is not None:
+                limit = min(page_size, remaining)
+                remaining -= limit
+            page = self._fetch(skip=skip, limit=limit, **extra)
+            if page:
+                yield page
+            if len(page) < limit:
+                return
+            skip += limit
+
+    def _scan(self, page_size=None, keys=None):
+        """
+        Yield every object matching the query, one page (list) at a time,
+        ordered by objectId. The last objectId seen is used as a cursor
+        instead of skip, so the scan isn't capped by Parse's maximum skip
+        and stays correct while the matched objects are being deleted.
+        The queryset's limit caps the total; its order and skip are
+        ignored.
+        """
+        page_size = page_size or self.MAX_PAGE_SIZE
+        remaining = self._options.get('limit')
+        options = dict(self._options, order='objectId')
+        options.pop('skip', None)
+        if keys is not None:
+            options['keys'] = keys
+        constraint = self._where.get('objectId')
+        if constraint is not None and not isinstance(constraint, dict):
+            # a single object, there is nothing to page through
+            options['where'] = json.dumps(self._where)
+            yield self._manager._fetch(**options)
+            return
+
+        last_id = None
+        while remaining is None or remaining > 0:
+            where = dict(self._where)
+            if last_id is not None:
+                where['objectId'] = dict(constraint or {}, **{'$gt': last_id})
+            options['where'] = json.dumps(where)
+            options['limit'] = page_size
+            if remaining is not None:
+                options['limit'] = min(page_size, remaining)
+                remaining -= options['limit']
+            page = self._manager._fetch(**options)
+            if not page:
+                return
+            # read the cursor first: the caller may delete the objects
+            last_id = page[-1].objectId
+            yield page
+            if len(page) < options['limit']:
+                return
+
+    def _id_pages(self):
+        """
+        Pages of the objects matching the query, with only their objectId,
+        to change or delete them. They are scanned by objectId unless the
+        queryset is ordered (see _ordered): then they are all read first,
+        since paging with skip while they change would shift the pages.
+        """
+        if self._ordered():
+            return iter(list(self._pages(keys='objectId')))
+        return self._scan(keys='objectId')
+
+    def partitions(self, count, by='objectId'):
+        """
+        Split the query into up to count querysets matching disjoint
+        ranges of objects, which together match exactly the objects this
+        queryset matches. Ranges are either of objectId (by its first
+        character) or of createdAt (equal time windows between the oldest
+        and the newest matching object). The queryset's order, skip and
+        limit are dropped.
+        """
+        if by not in ('objectId', 'createdAt'):
+            raise ValueError("can only partition by objectId or createdAt")
+        first = self._fetch(order=by, limit=1, keys=by)
+        if not first:
+            return []
+        last = self._fetch(order='-' + by, limit=1, keys=by)
+        low, high = getattr(first[0], by), getattr(last[0], by)
+
+        if by == 'objectId':
+            chars = [c for c in self.OBJECT_ID_CHARS if low[0] < c <= high[0]]
+            bounds = [chars[i * len(chars) // count] for i in range(1, count)
+                      if chars]
+        else:
+            bounds = [low + (high - low) * i // count for i in range(1, count)]
+        bounds = sorted(set(b for b in bounds if b > low))
+
+        return [self._range(by, lower, upper) for lower, upper in
+                zip([None] + bounds, bounds + [None])]
+
+    def _range(self, key, lower, upper):
+        """a copy of the queryset restricted to lower <= key < upper"""
+        s = copy.deepcopy(self)
+        for option in ('order', 'skip', 'limit'):
+            s._options.pop(option, None)
+        if lower is not None:
+            s._where[key]['$gte'] = Queryset.convert_to_parse(lower)
+        if upper is not None:
+            s._where[key]['$lt'] = Queryset.convert_to_parse(upper)
+        return s
+
+    def parallel_scan(self, partitions=4, by='objectId', page_size=None):
+        """
+        Yield every object matching the query, scanning partitions of it
+        (see partitions()) concurrently, each with its own cursor. Objects
+        come in no particular order.
+        """
+        scans = [qs._scan(page_size) for qs in self.partitions(partitions, by)]
+        for page in connection.interleave(scans, len(scans)):
+            for obj in page:
+                yield obj
+
+    def map_partitions(self, func, partitions=4, by='objectId',
+                       processes=False, page_size=None):
+        """
+        Call func on an iterator over the objects of each partition of the
+        query (see partitions()), concurrently, and return the list of
+        results. With processes=True, func runs in a pool of processes
+        rather than threads, for CPU bound work: func, its results and the
+        queryset's class must then be importable and picklable.
+        """
+        jobs = [(qs, func, page_size)
+                for qs in self.partitions(partitions, by)]
+        if not processes or not jobs:
+            return connection.parallel_map(_map_partition, jobs, len(jobs))
+
+        pool = multiprocessing.Pool(len(jobs))
+        try:
+            return pool.map(_map_partition, jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def _constraints(kw):
+        """the where clause of filter keyword arguments (field__operator)"""
+        where = collections.defaultdict(dict)
         for name, value in kw.items():
             parse_value = Queryset.convert_to_parse(value)
             attr, operator = Queryset.extract_filter_operator(name)
             if operator is None:
-                self._where[attr] = parse_value
+                where[attr] = parse_value
+            elif operator == 'within':
+                # (southwest, northeast) corners of a box
+                where[attr]['$within'] = {'$box': parse_value}
             else:
-                self._where[attr]['$' + operator] = parse_value
+                where[attr]['$' + operator] = parse_value
+        return dict(where)
+
+    def aggregate(self, partitions=None, **accumulators):
+        """
+        Compute aggregates of the fields of the objects matching the query,
+        given as name=Accumulator, e.g. aggregate(total=Sum('score'),
+        best=Max('score')), and return a dict of the results by name.
+
+        Objects are fetched a page at a time with only the fields needed,
+        and folded into the accumulators as they come, so memory use
+        doesn't grow with the number of objects. With partitions, that
+        many partitions of the query (see partitions()) are aggregated
+        concurrently and their results merged; partitions drop the order,
+        skip and limit of the queryset, so it mustn't have any.
+        """
+        results = self._aggregate(None, accumulators, partitions)
+        if None in results:
+            return results[None]
+        return dict((name, a.result(a.start()))
+                    for name, a in accumulators.items())
+
+    def group_by(self, field):
+        """group the objects matching the query by field, to aggregate()"""
+        return GroupBy(self, field)
+
+    def _aggregate(self, group, accumulators, partitions):
+        keys = set(a.field for a in accumulators.values() if a.field)
+        if group is not None:
+            keys.add(group)
+        qs = copy.deepcopy(self).only(*(sorted(keys) or ['objectId']))
+        klass = qs._manager.model_class
+        if not klass.LAZY_DECODING:
+            # leave pointers undecoded rather than fetching the objects they
+            # point to: only their objectIds are aggregated
+            qs._manager = copy.copy(qs._manager)
+            qs._manager.model_class = type(
+                klass.__name__, (klass,), {'LAZY_DECODING': True})
+        fold = functools.partial(_fold, group=group, accumulators=accumulators)
+
+        if partitions and (self._ordered() or 'limit' in self._options):
+            raise ValueError("can't aggregate partitions of an ordered, "
+                             "skipping or limited queryset")
+        if not partitions:
+            pages = self._ordered() and qs._pages() or qs._scan()
+            parts = [fold(o for page in pages for o in page)]
+        else:
+            parts = qs.map_partitions(fold, partitions)
+
+        states = {}
+        for part in parts:
+            for key, state in part.items():
+                if key not in states:
+                    states[key] = state
+                    continue
+                for name, accumulator in accumulators.items():
+                    states[key][name] = accumulator.merge(states[key][name],
+                                                          state[name])
+        return dict(
+            (key, dict((name, a.result(state[name]))
+                       for name, a in accumulators.items()))
+            for key, state in states.items())
+
+    def filter(self, *args, **kw):
+        """
+        Add constraints given as keyword arguments (field__operator=value)
+        or as Q objects
+        """
+        q = Q._from_where(self._where) & Q(**kw)
+        for other in args:
+            q = q & other
+        self._where = collections.defaultdict(dict, q._where())
         return self
 
     def order_by(self, order, descending=False):
@@ -190,11 +795,23 @@ class Queryset(object):
         self._options['order'] = descending and ('-' + order) or order
         return self
 
+    def using(self, client):
+        """a copy of the queryset that sends its requests with client"""
+        s = copy.deepcopy(self)
+        s._manager = copy.copy(self._manager)
+        s._manager.client = client
+        return s
+
+    def only(self, *keys):
+        """only fetch the given fields (plus objectId, createdAt, updatedAt)"""
+        self._options['keys'] = ','.join(keys)
+        return self
+
     def count(self):
         return self._fetch(count=True)
 
     def exists(self):
-        results = self._fetch()
+        results = self._fetch(limit=1, keys='objectId')
         return len(results) > 0
 
     def get(self):
@@ -205,12 +822,66 @@ class Queryset(object):
             raise QueryResourceMultipleResultsReturned
         return results[0]
 
-    def delete(self):
-        batcher = connection.ParseBatcher()
-        try:
-            batcher.batch_delete(self)
-        except ValueError:
-            pass
+    def delete(self, concurrency=None):
+        """
+        Delete every object matching the query and return how many were
+        deleted. objectIds are fetched a page at a time and each page is
+        deleted with parallel batches, so memory use stays bounded however
+        many objects match (unless the queryset is ordered or skips
+        objects: their objectIds are all fetched first).
+        """
+        batcher = connection.ParseBatcher(self._manager.client)
+        size = batcher.BATCH_SIZE
+        deleted = 0
+        for page in self._id_pages():
+            chunks = [page[i:i + size] for i in range(0, len(page), size)]
+            for results in connection.parallel_map(
+                    batcher.batch_delete, chunks, concurrency):
+                deleted += len([r for r in results if r.ok])
+        return deleted
+
+    def update(self, concurrency=None, **fields):
+        """
+        Set fields on every object matching the query without fetching
+        the objects: only their objectIds are read, and the given fields
+        are sent in parallel batches. Fields can also be changed with
+        atomic operations, e.g. score__increment=1 or tags__add=['new']
+        (see UPDATE_OPERATORS). Returns the number of objects updated and
+        a dict of the objectIds that failed to update and their errors.
+        As with delete(), the objectIds of an ordered or skipping queryset
+        are all fetched first.
+        """
+        payload = {}
+        for name, value in fields.items():
+            value = Queryset.convert_to_parse(value)
+            for operator, parse_operator in self.UPDATE_OPERATORS.items():
+                suffix = '__%s' % operator
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+                    key = operator == 'increment' and 'amount' or 'objects'
+                    value = {'__op': parse_operator, key: value}
+                    break
+            payload[name] = value
+
+        batcher = connection.ParseBatcher(self._manager.client)
+
+        def update_chunk(chunk):
+            methods = [functools.partial(o._update, fields=payload)
+                       for o in chunk]
+            return list(zip(chunk, batcher.batch(methods)))
+
+        size = batcher.BATCH_SIZE
+        updated, failed = 0, {}
+        for page in self._id_pages():
+            chunks = [page[i:i + size] for i in range(0, len(page), size)]
+            for results in connection.parallel_map(update_chunk, chunks,
+                                                   concurrency):
+                for obj, result in results:
+                    if result.ok:
+                        updated += 1
+                    else:
+                        failed[obj.objectId] = result.error
+        return updated, failed
 
     def __repr__(self):
         return unicode(self._fetch())
@@ -5,17 +5,23 @@ Contains unit tests for the Python Parse REST API wrapper
 """
 
 import os
+import json
 import sys
+import pickle
 import subprocess
 import unittest
 import datetime
 import random
+import tempfile
+import time
 
 
-from core import ResourceRequestNotFound
-from connection import register, ParseBatcher
-from datatypes import GeoPoint, Object, Function, ParseField, ParseManyToManyField
+from core import ResourceRequestNotFound, ParseError, ParseBatchError
+from connection import register, ParseBatcher, ParseClient, AtomicOpsBuffer, \
+    UnitOfWork, BatchResult
+from datatypes import GeoPoint, Object, Function, ParseField, ParseManyToManyField, Date, Binary, File
 from user import User
+from installation import Installation, Push
 import query
 
 try:
@@ -200,11 +206,32 @@ class TestManyToManyRelations(unittest.TestCase):
         self.customer1.addresses.add(self.address1, self.address2)
         self.assertEqual(self.customer1.addresses.all().count(), 2)
 
+    def test_count_and_exists_related_objects(self):
+        self.assertFalse(self.customer1.addresses.exists())
+        self.customer1.addresses.add(self.address1, self.address2)
+        self.assertTrue(self.customer1.addresses.exists())
+        self.assertEqual(self.customer1.addresses.count(), 2)
+
     def test_clear_related_objects(self):
         self.customer1.addresses.add(self.address1, self.address2)
         self.customer1.addresses.clear()
         self.assertEqual(self.customer1.addresses.all().count(), 0)
 
+    def test_clear_only_clears_own_related_objects(self):
+        self.customer1.addresses.add(self.address1, self.address2)
+        self.customer2.addresses.add(self.address3)
+        self.customer1.addresses.clear()
+        self.assertEqual(self.customer1.addresses.count(), 0)
+        self.assertEqual(self.customer2.addresses.count(), 1)
+
+    def test_add_skips_existing_related_objects(self):
+        self.customer1.addresses.add(self.address1)
+        self.customer1.addresses.add(self.address1, self.address2,
+                                     self.address2)
+        joint_rows = self.customer1.addresses.joint_class.Query.filter(
+            customer=self.customer1)
+        self.assertEqual(joint_rows.count(), 2)
+
     def test_clear_empty_related_objects(self):
         try:
             self.customer1.addresses.clear()
@@ -221,6 +248,32 @@ class TestManyToManyRelations(unittest.TestCase):
         self.assertEqual(self.customer1.addresses.all().count(), 2)
 
 
+class TestRelation(unittest.TestCase):
+    def setUp(self):
+        self.game = Game(title="Candyland")
+        self.game.save()
+        self.scores = [GameScore(score=s, player_name='John Doe')
+                       for s in range(1, 4)]
+        ParseBatcher().batch_save(self.scores)
+
+    def tearDown(self):
+        ParseBatcher().batch_delete(self.scores + [self.game])
+
+    def test_add_and_query_relation(self):
+        self.game.relation('scores').add(*self.scores)
+        self.game.save()
+        game = Game.Query.get(objectId=self.game.objectId)
+        self.assertEqual(game.scores.query().count(), 3)
+
+    def test_remove_from_relation(self):
+        self.game.relation('scores').add(*self.scores)
+        self.game.save()
+        self.game.relation('scores').remove(self.scores[0])
+        self.game.save()
+        related = self.game.scores.query()
+        self.assertEqual(sorted([s.score for s in related]), [2, 3])
+
+
 class TestObject(unittest.TestCase):
     def setUp(self):
         self.score = GameScore(
@@ -286,6 +339,47 @@ class TestObject(unittest.TestCase):
         self.assert_(GameScore.Query.filter(score=previous_score + 1).exists(),
                      'Failed to increment score on backend')
 
+    def testCanBufferAtomicOperations(self):
+        previous_score = self.score.score
+        self.score.tags = ['a']
+        self.score.save()
+        with AtomicOpsBuffer():
+            for _ in range(3):
+                self.score.increment('score')
+            self.score.add_unique_to_array('tags', ['a', 'b'])
+        self.assertEqual(self.score.score, previous_score + 3)
+        self.assertEqual(self.score.tags, ['a', 'b'])
+
+        score = GameScore.Query.get(objectId=self.score.objectId)
+        self.assertEqual(score.score, previous_score + 3)
+        self.assertEqual(score.tags, ['a', 'b'])
+
+    def testBufferReportsFailedAtomicOperations(self):
+        missing = GameScore(objectId='doesnotexist', score=1)
+        with self.assertRaises(ParseBatchError):
+            with AtomicOpsBuffer():
+                missing.increment('score')
+
+        # an error from a flush run by the timer is raised on exit
+        with self.assertRaises(ParseBatchError):
+            with AtomicOpsBuffer(max_delay=0.1):
+                missing.increment('score')
+                time.sleep(2)
+
+    def testSaveSupersedesPendingAtomicOperations(self):
+        previous_score = self.score.score
+        with AtomicOpsBuffer():
+            self.score.increment('score')
+            self.score.save()
+        score = GameScore.Query.get(objectId=self.score.objectId)
+        self.assertEqual(score.score, previous_score + 1)
+
+        with UnitOfWork():
+            self.score.save()
+            self.score.increment('score', 2)
+        score = GameScore.Query.get(objectId=self.score.objectId)
+        self.assertEqual(score.score, previous_score + 3)
+
     def testAssociatedObject(self):
         """test saving and associating a different object"""
         collectedItem = CollectedItem(type="Sword", isAwesome=True)
@@ -301,6 +395,23 @@ class TestObject(unittest.TestCase):
         self.assert_(qs.item.type == "Sword",
                    "Associated CollectedItem does not have correct attributes")
 
+    def testCascadeSave(self):
+        """test saving an object along with the new objects it points to"""
+        game = Game(title="Candyland")
+        collectedItem = CollectedItem(type="Sword", isAwesome=True)
+        self.score.game = game
+        self.score.item = collectedItem
+        collectedItem.game = game
+        self.score.save(cascade=True)
+        self.assert_(all(o.objectId is not None
+                         for o in (game, collectedItem, self.score)),
+                     "Cascade save didn't create referenced objects")
+
+        score = GameScore.Query.get(objectId=self.score.objectId)
+        self.assertEqual(score.item.game.objectId, game.objectId)
+        collectedItem.delete()
+        game.delete()
+
     def testBatch(self):
         """test saving, updating and deleting objects in batches"""
         scores = [GameScore(score=s, player_name='Jane', cheat_mode=False)
@@ -327,6 +438,64 @@ class TestObject(unittest.TestCase):
                      "batch_delete didn't delete objects")
 
 
+    def testUnitOfWork(self):
+        """test deferring saves and deletes until the end of a block"""
+        scores = [GameScore(score=s, player_name='Jane', cheat_mode=False)
+                    for s in range(5)]
+        with UnitOfWork():
+            for s in scores:
+                s.save()
+                s.save()
+            self.assert_(all(s.objectId is None for s in scores),
+                         "UnitOfWork didn't defer saves")
+        self.assert_(GameScore.Query.filter(player_name='Jane').count() == 5,
+                     "UnitOfWork didn't create objects")
+
+        with UnitOfWork():
+            for s in scores:
+                s.delete()
+        self.assert_(GameScore.Query.filter(player_name='Jane').count() == 0,
+                     "UnitOfWork didn't delete objects")
+
+    def testUnitOfWorkQueuesConflictingOperations(self):
+        self.score.tags = ['a']
+        self.score.save()
+        try:
+            with UnitOfWork():
+                self.score.add_to_array('tags', ['c'])
+                self.score.remove_from_array('tags', ['a'])
+                raise ValueError
+        except ValueError:
+            pass
+        score = GameScore.Query.get(objectId=self.score.objectId)
+        self.assertEqual(score.tags, ['a'])
+
+        with UnitOfWork():
+            score.add_to_array('tags', ['c'])
+            score.remove_from_array('tags', ['a'])
+        score = GameScore.Query.get(objectId=self.score.objectId)
+        self.assertEqual(score.tags, ['c'])
+
+    def testBatchReportsFailedOperations(self):
+        self.score.save()
+        missing = GameScore(objectId='doesnotexist', score=1)
+        results = ParseBatcher().batch_save([self.score, missing])
+        self.assert_(results[0].ok, "batch_save didn't save object")
+        self.assert_(not results[1].ok and not results[1].retryable,
+                     "batch_save didn't report failed operation")
+        self.assertIsNone(missing.updatedAt)
+
+        # after a timeout, only requests that are safe to repeat are retried
+        timeout = {'error': {'code': 124, 'error': 'timeout'}}
+        increment = {'score': {'__op': 'Increment', 'amount': 1}}
+        self.assertTrue(BatchResult({'method': 'DELETE'}, timeout).retryable)
+        self.assertTrue(BatchResult({'method': 'PUT', 'body': {'score': 1}},
+                                    timeout).retryable)
+        self.assertFalse(BatchResult({'method': 'PUT', 'body': increment},
+                                     timeout).retryable)
+        self.assertFalse(BatchResult({'method': 'POST', 'body': {}},
+                                     timeout).retryable)
+
     def test_empty_batch(self):
         scores = []
         batcher = ParseBatcher()
@@ -367,6 +536,60 @@ class TestTypes(unittest.TestCase):
         self.assert_(iso_date == self.now.isoformat(),
                      'Expected %s. Got %s' % (self.now.isoformat(), iso_date))
 
+    def testCanParseDate(self):
+        iso = u'2011-08-21T18:02:52.249Z'
+        expected = datetime.datetime.strptime(iso[:-1] + 'UTC', Date.FORMAT)
+        self.assertEqual(Date._from_str(iso), expected)
+        # anything outside of the fixed format goes through strptime
+        self.assertEqual(Date._from_str(u'2011-08-21T18:02:52.2Z'),
+                         datetime.datetime(2011, 8, 21, 18, 2, 52, 200000))
+
+    def testDateIsDecodedLazily(self):
+        iso = u'2011-08-21T18:02:52.249Z'
+        date = Date(iso)
+        self.assertEqual(date._to_native(), {'__type': 'Date', 'iso': iso})
+        self.assertEqual(date._date, Date._from_str(iso))
+
+    def testCanDecodeBinary(self):
+        binary = Binary.from_native(__type='Bytes', base64='aGVsbG8=')
+        self.assertEqual(binary.data, b'hello')
+        self.assertEqual(binary.view.tobytes(), b'hello')
+        self.assertEqual(binary._to_native()['base64'], 'aGVsbG8=')
+
+    def testCanEncodeBinaryFromBytes(self):
+        binary = Binary.from_bytes(b'hello')
+        self.assertEqual(binary._to_native(),
+                         {'__type': 'Bytes', 'base64': 'aGVsbG8='})
+
+
+class LazyGameScore(Object):
+    LAZY_DECODING = True
+
+
+class TestLazyDecoding(unittest.TestCase):
+    def setUp(self):
+        self.iso = u'2011-08-21T18:02:52.249Z'
+        self.raw_date = {'__type': 'Date', 'iso': self.iso}
+        self.score = LazyGameScore(score=1337, last_played=self.raw_date)
+
+    def testFieldsAreNotConvertedUntilRead(self):
+        self.assert_('last_played' not in self.score.__dict__)
+        self.assertEqual(self.score.score, 1337)
+
+    def testCanReadLazyField(self):
+        self.assertEqual(self.score.last_played,
+                         datetime.datetime(2011, 8, 21, 18, 2, 52, 249000))
+        self.assert_('last_played' in self.score.__dict__)
+
+    def testUntouchedFieldIsSavedRaw(self):
+        native = self.score._to_native()
+        self.assert_(native['last_played'] is self.raw_date)
+
+
+def sum_scores(scores):
+    """map_partitions function for TestQuery, run in another process"""
+    return sum(s.score for s in scores)
+
 
 class TestQuery(unittest.TestCase):
     """Tests of an object's Queryset"""
@@ -399,9 +622,152 @@ class TestQuery(unittest.TestCase):
 
     def test_delete_queryset(self):
         qs = GameScore.Query.all()
-        qs.delete()
+        self.assertEqual(qs.delete(), 5)
         self.assertEqual(GameScore.Query.all().count(), 0)
 
+    def test_delete_queryset_respects_filter(self):
+        self.assertEqual(GameScore.Query.filter(score__gt=3).delete(), 2)
+        self.assertEqual(GameScore.Query.all().count(), 3)
+
+    def test_delete_queryset_respects_skip(self):
+        self.assertEqual(GameScore.Query.all().order_by('score').skip(3).delete(),
+                         2)
+        self.assertEqual(sorted(s.score for s in GameScore.Query.all()),
+                         [1, 2, 3])
+
+    def test_delete_queryset_respects_order_and_limit(self):
+        qs = GameScore.Query.all().order_by('score', descending=True)
+        self.assertEqual(qs.limit(2).delete(), 2)
+        self.assertEqual(sorted(s.score for s in GameScore.Query.all()),
+                         [1, 2, 3])
+
+    def test_update_queryset(self):
+        updated, failed = GameScore.Query.filter(score__gt=3).update(
+            player_name='Jane Doe', score__increment=10)
+        self.assertEqual((updated, failed), (2, {}))
+        self.assertEqual(
+            sorted([s.score for s in GameScore.Query.filter(
+                player_name='Jane Doe')]),
+            [14, 15])
+
+    def test_update_queryset_respects_order_and_limit(self):
+        qs = GameScore.Query.all().order_by('score', descending=True)
+        updated, failed = qs.limit(2).update(player_name='Jane Doe',
+                                             concurrency=1)
+        self.assertEqual((updated, failed), (2, {}))
+        self.assertEqual(
+            sorted([s.score for s in GameScore.Query.filter(
+                player_name='Jane Doe')]),
+            [4, 5])
+
+    def test_retrieve_many(self):
+        ids = [s.objectId for s in reversed(self.scores)] + ['missing']
+        scores = GameScore.retrieve_many(ids)
+        self.assertEqual([s.score for s in scores[:-1]], [5, 4, 3, 2, 1])
+        self.assertIsNone(scores[-1])
+
+    def test_iterator(self):
+        qs = GameScore.Query.all()
+        self.assertEqual(
+            sorted(s.score for s in qs.iterator(page_size=2, prefetch=2)),
+            [1, 2, 3, 4, 5])
+        self.assertEqual(len(list(qs.skip(2).iterator(page_size=2))), 3)
+        qs = GameScore.Query.all().order_by('score', descending=True)
+        self.assertEqual(
+            [s.score for s in qs.skip(1).limit(3).iterator(page_size=2)],
+            [4, 3, 2])
+
+    def test_parallel_scan(self):
+        for by in ('objectId', 'createdAt'):
+            scores = GameScore.Query.all().parallel_scan(3, by=by, page_size=2)
+            self.assertEqual(sorted(s.score for s in scores), [1, 2, 3, 4, 5])
+
+    def test_map_partitions(self):
+        qs = GameScore.Query.filter(score__gt=1)
+        counts = qs.map_partitions(lambda scores: len(list(scores)), 3)
+        self.assertEqual(sum(counts), 4)
+        self.assertEqual(sum(qs.map_partitions(sum_scores, 2, processes=True)),
+                         14)
+
+    def test_client(self):
+        client = ParseClient(settings_local.APPLICATION_ID,
+                             settings_local.REST_API_KEY,
+                             master_key=settings_local.MASTER_KEY)
+        score = GameScore.Query.filter(score=1).using(client).get()
+        self.assertIs(score._client, client)
+        score.player_name = 'Jane Doe'
+        score.save()
+        self.assertEqual(GameScore.Query.get(score=1).player_name, 'Jane Doe')
+
+        with ParseClient('wrong', 'wrong'):
+            self.assertRaises(ParseError, GameScore.Query.all().count)
+        self.assertEqual(GameScore.Query.all().count(), 5)
+
+        # objects keep the client they were fetched with when pickled, and
+        # aren't bound to the default one
+        score = pickle.loads(pickle.dumps(score))
+        self.assertEqual(score._client.access_keys, client.access_keys)
+        self.assertNotIn('_client', GameScore.Query.get(score=1).__dict__)
+
+    def test_or_query(self):
+        qs = GameScore.Query.filter(query.Q(score__lt=2) | query.Q(score=4))
+        self.assertEqual(qs.count(), 2)
+        self.assertEqual([s.score for s in qs.order_by('score', descending=True)],
+                         [4, 1])
+
+        # a further filter narrows every alternative
+        qs = qs.filter(score__gt=1)
+        self.assertEqual(dict(qs._where), {'$or': [
+            {'score': {'$gt': 1, '$lt': 2}}, {'score': {'$eq': 4, '$gt': 1}}]})
+        self.assertEqual([s.score for s in qs], [4])
+
+        # chained bounds on a field tighten, other constraints are replaced
+        qs = GameScore.Query.filter(score__gt=1, score__in=[1, 2, 3])
+        qs = qs.filter(score__gt=2, score__lt=5, score__in=[2, 3, 4])
+        self.assertEqual(dict(qs._where), {
+            'score': {'$gt': 2, '$lt': 5, '$in': [2, 3]}})
+        self.assertEqual([s.score for s in qs], [3])
+        qs = GameScore.Query.filter(score=1).filter(score=2)
+        self.assertEqual(dict(qs._where), {'score': 2})
+
+    def test_aggregate(self):
+        aggregates = dict(total=query.Sum('score'), count=query.Count(),
+                          best=query.Max('score'), mean=query.Avg('score'))
+        expected = {'total': 15, 'count': 5, 'best': 5, 'mean': 3.0}
+        self.assertEqual(GameScore.Query.all().aggregate(**aggregates),
+                         expected)
+        self.assertEqual(
+            GameScore.Query.all().aggregate(partitions=2, **aggregates),
+            expected)
+        self.assertEqual(
+            GameScore.Query.filter(score__gt=10).aggregate(**aggregates),
+            {'total': 0, 'count': 0, 'best': None, 'mean': None})
+        top = GameScore.Query.all().order_by('score', descending=True).limit(2)
+        self.assertEqual(top.aggregate(low=query.Min('score')), {'low': 4})
+        self.assertRaises(ValueError, top.aggregate, partitions=2,
+                          low=query.Min('score'))
+        # a mean of zero isn't mistaken for no values
+        mean = query.Avg('score')
+        self.assertEqual(mean.result(mean.add(mean.start(), 0)), 0.0)
+
+    def test_group_by(self):
+        GameScore(score=5, player_name='Jane Doe').save()
+        groups = GameScore.Query.all().group_by('player_name').aggregate(
+            count=query.Count(), scores=query.Histogram('score'))
+        self.assertEqual(groups, {
+            'John Doe': {'count': 5, 'scores': {1: 1, 2: 1, 3: 1, 4: 1, 5: 1}},
+            'Jane Doe': {'count': 1, 'scores': {5: 1}}})
+
+        # pointers are grouped by objectId, without fetching their objects
+        item = CollectedItem(type='Sword')
+        item.save()
+        score = GameScore.Query.get(score=1)
+        score.item = item
+        score.save()
+        groups = GameScore.Query.filter(item__exists=True).group_by(
+            'item').aggregate(count=query.Count())
+        self.assertEqual(groups, {item.objectId: {'count': 1}})
+
     def test_delete_empty_queryset(self):
         qs = GameScore.Query.all()
         qs.delete()
@@ -505,6 +871,56 @@ class TestQuery(unittest.TestCase):
                      'Could not make inequality comparison with dates')
 
 
+class TestGeoQuery(unittest.TestCase):
+    def setUp(self):
+        self.cities = [
+            City(name='Rio de Janeiro', location=GeoPoint(-22.9, -43.2)),
+            City(name='São Paulo', location=GeoPoint(-23.5, -46.6167)),
+            City(name='Lisbon', location=GeoPoint(38.7, -9.1))
+            ]
+        for city in self.cities:
+            city.save()
+
+    def tearDown(self):
+        for city in self.cities:
+            city.delete()
+
+    def test_near_sphere(self):
+        nearby = City.Query.filter(location__nearSphere=GeoPoint(-23.0, -43.5),
+                                   location__maxDistanceInKilometers=1000)
+        self.assertEqual([c.name for c in nearby.iterator(page_size=1)],
+                         ['Rio de Janeiro', 'São Paulo'])
+
+    def test_within(self):
+        box = [GeoPoint(-25.0, -50.0), GeoPoint(-20.0, -45.0)]
+        self.assertEqual([c.name for c in City.Query.filter(location__within=box)],
+                         ['São Paulo'])
+
+
+class TestFile(unittest.TestCase):
+    def setUp(self):
+        self.source = tempfile.NamedTemporaryFile(suffix='.txt')
+        self.source.write(b'hello parse' * 1000)
+        self.source.flush()
+
+    def tearDown(self):
+        self.source.close()
+
+    def testCanUploadAndDownload(self):
+        uploaded = File.upload(self.source.name)
+        self.assert_(uploaded.url is not None, 'Could not upload file')
+
+        with tempfile.TemporaryFile() as dest:
+            uploaded.download(dest)
+            dest.seek(0)
+            self.assertEqual(dest.read(), b'hello parse' * 1000)
+
+    def testCanUploadManyFiles(self):
+        uploaded = File.upload_many([self.source.name] * 3)
+        self.assertEqual(len(uploaded), 3)
+        self.assert_(all(f.url is not None for f in uploaded))
+
+
 class TestFunction(unittest.TestCase):
     def setUp(self):
         '''create and deploy cloud functions'''
@@ -547,6 +963,117 @@ class TestFunction(unittest.TestCase):
         ret = star_func(movie="The Matrix")
         self.assertAlmostEqual(ret["result"], 4.5)
 
+    def test_function_map(self):
+        Review(movie="The Matrix", stars=5).save()
+        Review(movie="The Matrix", stars=4).save()
+
+        star_func = Function("averageStars", idempotent=True)
+        rets = star_func.map([{"movie": "The Matrix"}] * 3)
+        self.assertEqual([r["result"] for r in rets], [4.5] * 3)
+        rets = Function("noSuchFunction").map([{}])
+        self.assertIsInstance(rets[0], ParseError)
+
+        # memoized: new reviews don't change the result until it expires
+        Review(movie="The Matrix", stars=3).save()
+        self.assertAlmostEqual(star_func(movie="The Matrix")["result"], 4.5)
+
+
+class TestInstallation(unittest.TestCase):
+    IDS = ['2b6f4d3e-0000-4000-8000-00000000000%d' % i for i in range(3)]
+
+    def tearDown(self):
+        Installation.Query.filter(installationId__in=self.IDS).delete()
+
+    def test_bulk_upsert(self):
+        installations = [{'installationId': i, 'deviceType': 'android'}
+                         for i in self.IDS]
+        counts = Installation.bulk_upsert(installations, key='installationId')
+        self.assertEqual((counts['created'], counts['failed']), (3, {}))
+
+        installations[0]['channels'] = ['news']
+        counts = Installation.bulk_upsert(installations + installations[:1],
+                                          key='installationId')
+        self.assertEqual((counts['updated'], counts['unchanged']), (1, 2))
+        self.assertEqual(
+            Installation.Query.filter(installationId__in=self.IDS).count(), 3)
+        self.assertEqual(
+            Installation.Query.get(installationId=self.IDS[0]).channels,
+            ['news'])
+
+    def test_bulk_upsert_deletes_duplicates(self):
+        token = 'duplicated-device-token'
+        for installation_id in self.IDS[:2]:
+            Installation(installationId=installation_id, deviceToken=token,
+                         deviceType='android').save()
+        counts = Installation.bulk_upsert(
+            [{'deviceToken': token, 'deviceType': 'android',
+              'channels': ['news']}])
+        self.assertEqual((counts['updated'], counts['deleted']), (1, 1))
+        self.assertEqual(
+            Installation.Query.filter(deviceToken=token).count(), 1)
+
+
+class TestPush(unittest.TestCase):
+    """send_many, with Push._send replaced so nothing is sent"""
+
+    def setUp(self):
+        self.sent = []
+
+        def send(cls, data, where=None, **kw):
+            if data.get('alert') == 'fail':
+                raise ParseError('push failed')
+            self.sent.append((data, where, kw))
+            return {'result': True}
+        self._send = Push.__dict__['_send']
+        self.max_or_clauses = Push.MAX_OR_CLAUSES
+        Push._send = classmethod(send)
+
+    def tearDown(self):
+        Push._send = self._send
+        Push.MAX_OR_CLAUSES = self.max_or_clauses
+
+    @staticmethod
+    def _sorted(values):
+        return sorted(values, key=lambda v: json.dumps(v, sort_keys=True))
+
+    def test_send_many(self):
+        hi = {'alert': 'hi'}
+        results, stats = Push.send_many([
+            {'data': hi, 'channels': ['a']},
+            {'data': hi, 'channels': ['b', 'a']},
+            {'data': hi, 'where': {'deviceType': 'ios'}},
+            {'data': hi, 'where': {'deviceType': 'android'}},
+            {'data': hi, 'channels': ['a'], 'expiration_interval': 60},
+            {'data': {'alert': 'fail'}},
+            ])
+        self.assertEqual(self._sorted(self.sent), self._sorted([
+            (hi, None, {'channels': ['a', 'b']}),
+            (hi, {'$or': [{'deviceType': 'ios'}, {'deviceType': 'android'}]},
+             {}),
+            (hi, None, {'channels': ['a'], 'expiration_interval': 60}),
+            ]))
+        self.assertIs(results[0], results[1])
+        self.assertIs(results[2], results[3])
+        self.assertIsNot(results[0], results[2])
+        self.assertIsInstance(results[5], ParseError)
+        self.assertEqual((stats['pushes'], stats['sends'], stats['failed']),
+                         (6, 4, 1))
+
+    def test_send_many_chunks_where_queries(self):
+        Push.MAX_OR_CLAUSES = 2
+        wheres = [{'deviceType': t} for t in ('ios', 'android', 'winphone')]
+        results, stats = Push.send_many(
+            [{'data': {'alert': 'hi'}, 'where': w} for w in wheres])
+        self.assertEqual(self._sorted(where for _, where, _ in self.sent),
+                         self._sorted([{'$or': wheres[:2]}, wheres[2]]))
+        self.assertIs(results[0], results[1])
+        self.assertIsNot(results[1], results[2])
+
+    def test_send_many_rejects_where_and_channels(self):
+        self.assertRaises(ValueError, Push.send_many, [
+            {'data': {'alert': 'hi'}, 'where': {}, 'channels': ['a']}])
+        self.assertEqual(self.sent, [])
+
 
 class TestUser(unittest.TestCase):
     USERNAME = "dhelmet@spaceballs.com"
@@ -605,6 +1132,27 @@ class TestUser(unittest.TestCase):
         self.assert_(User.Query.filter(phone=phone_number).exists(),
                      'Failed to update user data. New info not on Parse')
 
+    def test_act_as(self):
+        user = self._get_logged_user()
+        with user.act_as():
+            me = User.GET('/me')
+        self.assertEqual(me['objectId'], user.objectId)
+        self.assertRaises(ParseError, User.GET, '/me')
+
+    def test_validate_session(self):
+        user = self._get_logged_user()
+        token = user.sessionToken
+        self.assertEqual(User.validate_session(token).objectId, user.objectId)
+        self.assertIsNone(User.validate_session('not-a-session-token'))
+
+        anonymous = User.Query.get(username=self.username)
+        anonymous.authenticate(session_token=token)
+        self.assertTrue(anonymous.is_authenticated())
+
+        user.logout()
+        self.assertFalse(user.is_authenticated())
+        self.assertIsNone(User.validate_session(token))
+
     def test_user_login_uses_subclass(self):
         class CustomUser(User):
             @property
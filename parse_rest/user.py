@@ -12,9 +12,10 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from core import ResourceRequestLoginRequired
-from connection import API_ROOT
-from datatypes import ParseResource, ParseType
+from core import ResourceRequestBadRequest, ResourceRequestLoginRequired, \
+    ResourceRequestNotFound
+from connection import API_ROOT, ParseClient, Session, with_client
+from datatypes import ParseResource
 from query import QueryManager
 
 
@@ -38,23 +39,72 @@ class User(ParseResource):
         'username', 'sessionToken']
 
     def is_authenticated(self):
-        return self.sessionToken is not None
+        return getattr(self, 'sessionToken', None) is not None
 
     def authenticate(self, password=None, session_token=None):
+        """
+        Log the user in with their password, or with a session token if
+        it is valid and belongs to this user
+        """
         if self.is_authenticated(): return
 
         if password is not None:
-            self = User.login(self.username, password)
+            session_token = User.login(self.username, password).sessionToken
 
-        user = User.retrieve(self.objectId)
-        if user.objectId == self.objectId and user.sessionToken == session_token:
+        user = session_token and User.validate_session(session_token)
+        if user and user.objectId == self.objectId:
             self.sessionToken = session_token
 
+    @classmethod
+    def validate_session(cls, session_token):
+        """
+        Return the user a session token belongs to, or None if the token
+        isn't valid. Tokens are checked with /users/me, and the results
+        are cached by the client for a while (see ParseClient.SESSION_TTL
+        and INVALID_SESSION_TTL).
+        """
+        client = ParseClient.current()
+        user_data = client.sessions.get(session_token)
+        if user_data is not None:
+            return cls(**user_data)
+        if client.invalid_sessions.get(session_token):
+            return None
+
+        try:
+            user_data = cls.GET('/me', extra_headers={
+                'X-Parse-Session-Token': session_token})
+        except (ResourceRequestBadRequest, ResourceRequestLoginRequired,
+                ResourceRequestNotFound):
+            client.invalid_sessions.set(session_token, True)
+            return None
+        user_data['sessionToken'] = session_token
+        client.sessions.set(session_token, user_data)
+        return cls(**user_data)
+
     @login_required
     def session_header(self):
         return {'X-Parse-Session-Token': self.sessionToken}
 
     @login_required
+    def logout(self):
+        """end the user's session, on Parse and in the session cache"""
+        client = ParseClient.current()
+        client.sessions.pop(self.sessionToken)
+        client.invalid_sessions.set(self.sessionToken, True)
+        url = '/'.join([API_ROOT, 'logout'])
+        self.POST(url, extra_headers=self.session_header())
+        self.sessionToken = None
+
+    @login_required
+    def act_as(self):
+        """
+        context manager sending the requests in its with block on behalf
+        of this user (see connection.Session)
+        """
+        return Session(self.sessionToken)
+
+    @login_required
+    @with_client
     def save(self, **kwargs):
         session_header = {'X-Parse-Session-Token': self.sessionToken}
         url = self._absolute_url
@@ -62,6 +112,7 @@ class User(ParseResource):
         return self.__class__.PUT(url, extra_headers=session_header, **data)
 
     @login_required
+    @with_client
     def delete(self):
         session_header = {'X-Parse-Session-Token': self.sessionToken}
         return self.DELETE(self._absolute_url, extra_headers=session_header)
@@ -75,7 +126,10 @@ class User(ParseResource):
     @classmethod
     def login(cls, username, passwd):
         login_url = '/'.join([API_ROOT, 'login'])
-        return cls(**User.GET(login_url, username=username, password=passwd))
+        user_data = User.GET(login_url, username=username, password=passwd)
+        ParseClient.current().sessions.set(user_data['sessionToken'],
+                                           dict(user_data))
+        return cls(**user_data)
 
     @staticmethod
     def login_auth(auth):
@@ -90,13 +144,12 @@ class User(ParseResource):
         url = '/'.join([API_ROOT, 'requestPasswordReset'])
         try:
             User.POST(url, email=email)
-            return True
         except:
             return False
-
-    def _to_native(self):
-        return dict([(k, ParseType.convert_to_parse(v, as_pointer=True))
-                     for k, v in self._editable_attrs.items()])
+        # the user's sessions won't outlive the reset: stop trusting them
+        ParseClient.current().sessions.remove_if(
+            lambda user_data: user_data.get('email') == email)
+        return True
 
     def __repr__(self):
         return '<User:%s (Id %s)>' % (self.username, self.objectId)